@@ -5,35 +5,36 @@
 # Arbitrary text display
 #
 
-import datetime
-import time
 import os
 import io
-import math
 import re
+import functools
 
 from helpers import make_font
+from helpers import char_size
+from glyphs import GlyphAtlas
 from helpers import time_diff
-from helpers import tdiff_text
-from helpers import is_active_hours
 from helpers import ApiException
+from schedule import ActiveHours
+from render_scheduler import RenderScheduler
+from render_scheduler import earliest
+import reltime
 
 from oled_options import get_device
-from luma.core.render import canvas
-from PIL import ImageFont
-from dateutil.parser import parse
-import RPi.GPIO as GPIO # Import Raspberry Pi GPIO library
+from framediff import FrameDiffer
+import button
+import clock
+import metrics
 
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path='.env')
 
-data_refresh_delay_normal = 30
+data_refresh_delay_normal = 30 # Check atd.txt for changes every X seconds
 
-screen_data_refresh_delay = 1 # Redraw (cached) data every X seconds
 screen_active_time = 240 # How long the screen is active after button press (during off-hours)
 
-start_time = datetime.datetime.now()
+start_time = clock.datetime_now()
 
 row = 0
 max_rows = 0
@@ -41,28 +42,34 @@ font_size = 15
 width = 0
 height = 0
 line_height = 0
-button_gpio_pin = 15
+atlas = None
 
 button_press_time = None
-atd_file_data = None
-last_get_deps = None
+active_hours = None
+next_redraw_at = None
+atd_template = None
+atd_file_mtime = None
+last_template_check = None
+
+atd_file = "atd.txt"
+
+# Functions that may be called from atd.txt as !name(number), with the
+# function telling when their text changes
+template_functions = {'tdiff_text': (reltime.relative, reltime.changes_at)}
+template_token = re.compile(r'!([a-z_]+)\((\d+)\)')
 
 
 ACTIVE_HOURS = os.getenv("ACTIVE_HOURS")
 
 def button_callback(channel):
     global button_press_time
+    global last_template_check
     # Set button press time
-    button_press_time = datetime.datetime.now()
-    last_get_deps = None
+    button_press_time = clock.datetime_now()
+    # Look for changes in atd.txt
+    last_template_check = None
     print("Button was pushed!")
 
-def button_setup():
-    GPIO.setwarnings(False) # Ignore warning for now
-    GPIO.setmode(GPIO.BOARD) # Use physical pin numbering
-    GPIO.setup(button_gpio_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # Set pin to be an input pin and set initial value to be pulled low (off)
-    GPIO.add_event_detect(button_gpio_pin,GPIO.RISING,callback=button_callback) # Setup event on pin rising edge
-
 def print_out(text='', draw=None):
     global row
     if draw is None:
@@ -70,62 +77,139 @@ def print_out(text='', draw=None):
     else:
         for start in range(0, len(text) + 1, max_chars):
             row += 1
-            draw.text((0,row * line_height), text[start:(start + max_chars)], font=font, fill="white")
+            atlas.text(draw, (0, row * line_height), text[start:(start + max_chars)])
+
+def compile_template(lines):
+    # Split every line into literal strings and bound calls, once per change
+    template = []
+    for line in lines:
+        segments = []
+        pos = 0
+        for match in template_token.finditer(line):
+            funcs = template_functions.get(match.group(1))
+            if funcs is None:
+                continue # Unknown functions are shown as is
+            if match.start() > pos:
+                segments.append(line[pos:match.start()])
+            arg = int(match.group(2))
+            segments.append((functools.partial(funcs[0], arg), functools.partial(funcs[1], arg)))
+            pos = match.end()
+        if pos < len(line):
+            segments.append(line[pos:])
+        template.append(tuple(segments))
+    return template
+
+def render_line(segments, now):
+    # Returns the line at epoch second now and when it changes, None if never
+    parts = []
+    changes_at = None
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+        else:
+            text, changes = segment
+            parts.append(text(now))
+            changes_at = earliest(changes_at, changes(now))
+    return ''.join(parts), changes_at
+
+def load_template():
+    global atd_template
+    global atd_file_mtime
+    global last_template_check
+    last_template_check = clock.datetime_now()
+    try:
+        mtime = os.stat(atd_file).st_mtime_ns
+        if atd_template is not None and mtime == atd_file_mtime:
+            return
+        with io.open(atd_file, "r", encoding="utf-8") as f:
+            atd_template = compile_template(f.readlines())
+        atd_file_mtime = mtime
+    except OSError as e:
+        if atd_template is None:
+            atd_template = [(str(e),)]
 
 def draw_atd(draw):
+    # Returns when the drawn content changes next
     global row
-    global last_get_deps
-    global atd_file_data
-    if atd_file_data is None or last_get_deps is None or time_diff(last_get_deps) > data_refresh_delay:
-        f = io.open("atd.txt", "r", encoding="utf-8")
-        atd_file_data = f.readlines()
-        f.close()
+    # Only look at the file now and then, it is recompiled when it changed
+    if atd_template is None or last_template_check is None or time_diff(last_template_check) > data_refresh_delay_normal:
+        load_template()
     row = 0
+    changes_at = last_template_check.timestamp() + data_refresh_delay_normal + 1
+    now = int(clock.now())
 
-    for line in atd_file_data:
-        matches = re.findall("(!([a-z_]+)\((\d+)\))", line)
-        for match in matches:
-            ret = {}
-            exec('val = {}({})'.format(match[1], match[2]), {'tdiff_text': tdiff_text}, ret)
-            line = line.replace(match[0], ret['val'].decode("utf-8"))
-        print_out(line, draw=draw)
+    for segments in atd_template:
+        text, line_changes_at = render_line(segments, now)
+        print_out(text, draw=draw)
+        changes_at = earliest(changes_at, line_changes_at)
         if row == max_rows:
             break
+    return changes_at
+
+
+def draw_screen(draw):
+    global next_redraw_at
+    # Only draw if started recently
+    if time_diff(start_time) < screen_active_time:
+        changes_at = draw_atd(draw)
+        active_until = start_time.timestamp() + screen_active_time
+    # Or only draw if active hours
+    elif active_hours is not None and active_hours.is_active():
+        changes_at = draw_atd(draw)
+        active_until = active_hours.next_change()
+    # Or if button is pressed recently
+    elif button_press_time is not None and time_diff(button_press_time) < screen_active_time:
+        changes_at = draw_atd(draw)
+        active_until = button_press_time.timestamp() + screen_active_time
+    else:
+        next_redraw_at = next_change()
+        return False
+    next_redraw_at = earliest(changes_at, active_until)
+    return True
+
+def next_redraw():
+    # When the screen content can change next, None if only events change it
+    return next_redraw_at
+
+def next_change():
+    # When the screen turns on by itself, None if only the button can do it
+    if active_hours is None:
+        return None
+    return active_hours.next_change()
+
+def setup(size, screen_font, fetch_scheduler=None):
+    global width, height, font, max_chars, line_height, max_rows, start_time, active_hours, atlas
+    width, height = size
+    font = screen_font
+    atlas = GlyphAtlas(font)
+    char_width, line_height = char_size(font)
+    max_chars = width // char_width
+    max_rows = height // line_height
+    start_time = clock.datetime_now()
+    if ACTIVE_HOURS is not None:
+        active_hours = ActiveHours(ACTIVE_HOURS, screen_active_time)
+    button.add_listener(button_callback)
 
 def main():
 
     while True:
-        with canvas(device) as draw:
-            # Only draw if started recently
-            if time_diff(start_time) < screen_active_time:
-                draw_atd(draw)
-            # Or only draw if active hours
-            elif ACTIVE_HOURS is not None and is_active_hours(ACTIVE_HOURS, screen_active_time):
-                draw_atd(draw)
-            # Or if button is pressed recently
-            elif button_press_time is not None and time_diff(button_press_time) < screen_active_time:
-                draw_atd(draw)
-        time.sleep(screen_data_refresh_delay)
+        with frame.canvas() as draw:
+            draw_screen(draw)
+        # Sleep until something visible changes or a button press
+        render_scheduler.wait_until(next_redraw_at)
 
 if __name__ == "__main__":
     try:
         device = get_device()
-        width = device.width
-        height = device.height
-        font = make_font("ProggyTiny.ttf", font_size)
-        # Find char width & height
-        _cw, _ch = (0, 0)
-        for i in range(32, 128):
-            w, h = font.getsize(chr(i))
-            _cw = max(w, _cw)
-            _ch = max(h, _ch)
-        max_chars = width // _cw
-        line_height = _ch
-        max_rows = height // _ch
-        start_time = datetime.datetime.now()
-        button_setup()
+        frame = FrameDiffer(device)
+        render_scheduler = RenderScheduler()
+        setup(device.size, make_font("ProggyTiny.ttf", font_size))
+        # After the screen has seen the press
+        button.add_listener(render_scheduler.notify)
+        button.setup()
+        metrics.start_exporter()
         main()
     except KeyboardInterrupt:
         pass
     finally:
-        GPIO.cleanup() # Clean up
+        button.cleanup()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline benchmarks for fetch, parse and render
+#
+# Replays the recorded API responses in bench/fixtures through the real
+# fetch/parse/draw code of pisl, srv and atd against a luma dummy device, no
+# GPIO or network needed. Every stage reports median time and peak memory
+# and is compared against bench/baseline.json. Timings depend on the
+# machine, so no baseline is shipped: the first run on a machine writes it.
+#
+#   python bench/bench.py                   Run and compare against the baseline
+#   python bench/bench.py --save-baseline   Run and store the result as new baseline
+#
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+fixture_dir = os.path.join(bench_dir, 'fixtures')
+baseline_path = os.path.join(bench_dir, 'baseline.json')
+sys.path.insert(0, root_dir)
+
+# Screen configuration, set before the screen modules are imported
+os.environ.setdefault('SL_SITE_ID', '9294')
+os.environ.setdefault('REALTIME_API_KEY', 'bench')
+os.environ.setdefault('PREFERRED_JOURNEY_DIRECTION', '1')
+os.environ.setdefault('TRANSPORT_TYPE', 'Metros')
+os.environ.setdefault('SRV_STREETNAME', 'Testgatan 1')
+os.environ.setdefault('SRV_CITY', 'Huddinge')
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from PIL import Image, ImageDraw
+from luma.core.device import dummy
+
+import disk_cache
+import http_client
+import jsonstream
+import logsink
+from helpers import make_font
+from fetcher import FetchScheduler
+from framediff import FrameDiffer
+
+font_size = 15
+tolerance = 0.25 # Report a regression when a stage is more than 25% slower...
+min_regression_ms = 0.05 # ...and at least this much slower
+
+sl_time = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+srv_date = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def load_fixture(name):
+    with io.open(os.path.join(fixture_dir, name), 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def rebase_sl(text):
+    # Move all times so the response looks like it was fetched just now
+    fmt = '%Y-%m-%dT%H:%M:%S'
+    recorded = datetime.datetime.strptime(json.loads(text)['ResponseData']['LatestUpdate'], fmt)
+    shift = datetime.datetime.now().replace(microsecond=0) - recorded
+    return sl_time.sub(lambda m: (datetime.datetime.strptime(m.group(0), fmt) + shift).strftime(fmt), text)
+
+
+def rebase_srv(text):
+    # Move all dates so the first pickup is the day after tomorrow
+    first = min(datetime.date.fromisoformat(d) for d in srv_date.findall(text))
+    shift = datetime.date.today() + datetime.timedelta(days=2) - first
+    return srv_date.sub(lambda m: (datetime.date.fromisoformat(m.group(0)) + shift).isoformat(), text)
+
+
+class FixtureAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter answering from fixtures instead of the network, so
+    the whole requests/http_client path is still exercised.
+    """
+
+    def __init__(self, routes):
+        requests.adapters.BaseAdapter.__init__(self)
+        self.routes = routes # [(url substring, body bytes)]
+
+    def send(self, request, **kwargs):
+        for pattern, body in self.routes:
+            if pattern in request.url:
+                break
+        else:
+            raise requests.ConnectionError('No fixture for {}'.format(request.url))
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.reason = 'OK'
+        resp.headers = CaseInsensitiveDict({'Content-Type': 'application/json; charset=utf-8'})
+        resp.raw = io.BytesIO(body)
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class RecordingDraw:
+    # Stands in for ImageDraw to time text layout without rasterisation
+
+    def __init__(self):
+        self.calls = 0
+
+    def text(self, xy, text, **kwargs):
+        self.calls += 1
+
+    def bitmap(self, xy, bitmap, **kwargs):
+        self.calls += 1
+
+
+def install_fixtures():
+    routes = [
+        ('realtimedeparturesV4', rebase_sl(load_fixture('sl_realtimedeparturesV4.json')).encode('utf-8')),
+        ('sewagePickup', rebase_srv(load_fixture('srv_sewagePickup.json')).encode('utf-8')),
+    ]
+    adapter = FixtureAdapter(routes)
+    session = http_client.get_session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Start cold, without cached payloads or font metrics from earlier runs
+    disk_cache.cache_dir = tempfile.mkdtemp(prefix='pisl-bench-')
+    logsink.log_dir = os.path.join(disk_cache.cache_dir, 'logs')
+    return dict(routes)
+
+
+def measure(func, repeat):
+    times = []
+    for _i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    # Memory is measured in a separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    func()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'median_ms': statistics.median(times) * 1000,
+        'min_ms': min(times) * 1000,
+        'peak_kb': peak / 1024.0,
+    }
+
+
+def setup_screen(name, device, font):
+    module = __import__(name)
+    if name == 'atd':
+        module.atd_file = os.path.join(fixture_dir, 'atd.txt')
+    module.setup(device.size, font, FetchScheduler())
+    return module
+
+
+def bench_render(results, name, module, device, repeat):
+    # Text layout alone, layout + rasterisation, and pushing to the device
+    results[name + '.layout'] = measure(lambda: module.draw_screen(RecordingDraw()), repeat)
+
+    def render():
+        image = Image.new(device.mode, device.size)
+        module.draw_screen(ImageDraw.Draw(image))
+        return image
+    results[name + '.render'] = measure(render, repeat)
+    image = render()
+    results[name + '.push_full'] = measure(lambda: device.display(image), repeat)
+    frame = FrameDiffer(device)
+    frame.display(image)
+    results[name + '.push_unchanged'] = measure(lambda: frame.display(image), repeat)
+
+
+def run(repeat):
+    bodies = install_fixtures()
+    device = dummy(width=128, height=64)
+    font = make_font("ProggyTiny.ttf", font_size)
+    results = {}
+
+    pisl = setup_screen('pisl', device, font)
+    sl_body = bodies['realtimedeparturesV4']
+    results['sl.json'] = measure(lambda: json.loads(sl_body), repeat)
+    sl_chunks = [sl_body[i:i + jsonstream.chunk_size] for i in range(0, len(sl_body), jsonstream.chunk_size)]
+    sl_keys = {'StatusCode': None, 'Message': None}
+    sl_keys.update((transport_type, None) for transport_type in pisl.TRANSPORT_TYPES)
+    results['sl.extract'] = measure(lambda: jsonstream.extract(sl_chunks, sl_keys), repeat)
+    results['sl.fetch'] = measure(pisl.fetch_departures, repeat)
+    payload = pisl.fetch_departures()
+    results['sl.group'] = measure(lambda: pisl.parse_departures(payload), repeat)
+    pisl.deps_fetcher.run()
+    bench_render(results, 'sl', pisl, device, repeat)
+
+    srv = setup_screen('srv', device, font)
+    srv_body = bodies['sewagePickup']
+    results['srv.json'] = measure(lambda: json.loads(srv_body), repeat)
+    results['srv.fetch'] = measure(srv.fetch_services, repeat)
+    payload = srv.fetch_services()
+    results['srv.group'] = measure(lambda: srv.parse_services(payload), repeat)
+    srv.srv_fetcher.run()
+    bench_render(results, 'srv', srv, device, repeat)
+
+    atd = setup_screen('atd', device, font)
+    results['atd.compile'] = measure(lambda: atd.compile_template(load_fixture('atd.txt').splitlines(True)), repeat)
+    bench_render(results, 'atd', atd, device, repeat)
+
+    for stage, name in (('sl', 'pisl'), ('srv', 'srv'), ('atd', 'atd')):
+        results[stage + '.first_frame'] = {'median_ms': first_frame(name) * 1000}
+    return results
+
+
+def first_frame(name):
+    # Time to first frame of a fresh interpreter, as reported by FrameDiffer
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--first-frame', name],
+        cwd=root_dir, stderr=subprocess.DEVNULL)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])['first_frame']
+
+
+def run_first_frame(name):
+    install_fixtures()
+    device = dummy(width=128, height=64)
+    frame = FrameDiffer(device)
+    module = setup_screen(name, device, make_font("ProggyTiny.ttf", font_size))
+    fetcher = getattr(module, 'deps_fetcher', None) or getattr(module, 'srv_fetcher', None)
+    if fetcher is not None:
+        fetcher.run()
+    with frame.canvas() as draw:
+        module.draw_screen(draw)
+    sys.__stdout__.write(json.dumps({'first_frame': frame.first_frame_time}) + '\n')
+
+
+def compare(results, baseline):
+    regressions = []
+    print('{:<22} {:>10} {:>10} {:>10} {:>8}'.format('stage', 'ms', 'base ms', 'peak kB', 'change'))
+    for stage, result in sorted(results.items()):
+        base = baseline.get(stage, {}).get('median_ms')
+        ms = result['median_ms']
+        change = ''
+        if base:
+            change = '{:+.0%}'.format(ms / base - 1)
+            if ms > base * (1 + tolerance) and ms - base > min_regression_ms:
+                regressions.append(stage)
+                change += ' !'
+        print('{:<22} {:>10.3f} {:>10} {:>10} {:>8}'.format(
+            stage, ms, '{:.3f}'.format(base) if base else '-',
+            '{:.1f}'.format(result['peak_kb']) if 'peak_kb' in result else '-', change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pisl offline benchmarks')
+    parser.add_argument('--repeat', type=int, default=50, help='runs per stage')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as new baseline')
+    parser.add_argument('--baseline', default=baseline_path, help='baseline file')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--first-frame', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.first_frame:
+        with contextlib.redirect_stdout(sys.stderr):
+            run_first_frame(args.first_frame)
+        return 0
+
+    # Keep the screens' own output out of the report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    elif not args.save_baseline:
+        print('No baseline at {}, nothing to compare against: this run becomes the baseline'.format(args.baseline))
+        args.save_baseline = True
+    regressions = compare(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+        return 0
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
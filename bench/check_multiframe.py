@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline check of driving several displays from one frame
+#
+# Tiles a frame over two luma dummy devices, one of them slowed down to
+# 200 ms per push like a congested bus, and draws frames 10 ms apart.
+# Checks that drawing is not held up by the slow device, that the fast one
+# gets every frame, that frames are dropped for the slow one and that both
+# end up showing the last frame. Exits non-zero when a check fails.
+#
+#   python bench/check_multiframe.py
+#
+
+import os
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+from luma.core.device import dummy
+from PIL import Image, ImageDraw
+
+import framediff
+
+frame_count = 20
+frame_interval = 0.01 # Seconds between frames
+slow_push = 0.2 # Seconds the slow device takes per push
+
+
+class CountingDevice(dummy):
+
+    def __init__(self, delay=0, **kwargs):
+        dummy.__init__(self, **kwargs)
+        self.delay = delay
+        self.pushes = 0
+
+    def display(self, image):
+        time.sleep(self.delay)
+        dummy.display(self, image)
+        self.pushes += 1
+
+
+def check(failures, ok, message):
+    print('{} {}'.format('ok  ' if ok else 'FAIL', message))
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    fast = CountingDevice(width=128, height=64)
+    slow = CountingDevice(delay=slow_push, width=128, height=64)
+    frame = framediff.MultiFrame([fast, slow], tile=True)
+    key = (('result', 'dropped'),)
+    dropped = framediff.frames.values.get(key, 0)
+    failures = []
+
+    start = time.monotonic()
+    for index in range(frame_count):
+        # Different on both devices every frame
+        image = Image.new(frame.mode, frame.size)
+        ImageDraw.Draw(image).rectangle((index * 4, index, index * 4 + 3, 127 - index), fill='white')
+        frame.display(image)
+        time.sleep(frame_interval)
+    loop_time = time.monotonic() - start
+    check(failures, loop_time < frame_count * frame_interval + slow_push,
+        'drew {} frames in {:.2f}s'.format(frame_count, loop_time))
+
+    frame.pool.shutdown(wait=True)
+    dropped = framediff.frames.values.get(key, 0) - dropped
+    check(failures, fast.pushes == frame_count, 'fast device got {} of {} frames'.format(fast.pushes, frame_count))
+    check(failures, dropped > 0 and slow.pushes + dropped == frame_count,
+        'slow device got {} frames, {} dropped'.format(slow.pushes, dropped))
+    for index, device in enumerate(frame.devices):
+        part = image.crop((0, index * 64, 128, (index + 1) * 64))
+        check(failures, device.image.tobytes() == part.convert(device.mode).tobytes(),
+            'device {} shows the last frame'.format(index))
+
+    if failures:
+        sys.exit('{} check(s) failed'.format(len(failures)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline check of the caching API proxy
+#
+# Runs proxy.py against a local stub upstream serving the SL and SRV
+# fixtures and checks, for both routes, that concurrent misses share one
+# upstream call, that the cached payload is served while upstream fails,
+# and that the proxy answers 502 and drops the payload once it is older
+# than stale_factor TTLs. Exits non-zero when a check fails.
+#
+#   python bench/check_proxy.py
+#
+
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+import proxy
+
+clients = 20 # Concurrent requests for the same site or address
+upstream_delay = 0.3 # Seconds the stub takes to answer, so the requests overlap
+burst_ttl = 30 # TTL while the clients connect, well past any SYN retry
+ttl = 0.5 # TTL for the stale checks
+stale_factor = 4
+
+routes = {
+    'sl': (proxy.sl_path + '?siteid=9294&timewindow=30', 'sl_realtimedeparturesV4.json'),
+    'srv': (proxy.srv_path + '?query=Testgatan%201&city=Huddinge', 'srv_sewagePickup.json'),
+}
+
+
+def load_fixture(name):
+    with io.open(os.path.join(bench_dir, 'fixtures', name), 'r', encoding='utf-8') as file:
+        return file.read().encode('utf-8')
+
+
+class Upstream:
+    # What the stub answers and how often each path was called
+    bodies = {urlsplit(path).path: load_fixture(name) for path, name in routes.values()}
+    calls = {}
+    failing = False
+    lock = threading.Lock()
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        with Upstream.lock:
+            Upstream.calls[path] = Upstream.calls.get(path, 0) + 1
+        time.sleep(upstream_delay)
+        status, body = (500, b'{}') if Upstream.failing else (200, Upstream.bodies.get(path, b'{}'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def get(base, route):
+    # Returns (status, body)
+    try:
+        with urlopen(base + routes[route][0], timeout=10) as resp:
+            return resp.status, resp.read()
+    except HTTPError as e:
+        return e.code, e.read()
+
+
+def check(failures, ok, message):
+    print('{} {}'.format('ok  ' if ok else 'FAIL', message))
+    if not ok:
+        failures.append(message)
+
+
+def upstream_calls(route):
+    return Upstream.calls.get(urlsplit(routes[route][0]).path, 0)
+
+
+def check_route(failures, base, route):
+    proxy.PROXY_SL_TTL = proxy.PROXY_SRV_TTL = burst_ttl
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        answers = list(pool.map(lambda _i: get(base, route), range(clients)))
+    calls = upstream_calls(route)
+    check(failures, calls == 1, '{}: {} concurrent misses made {} upstream call(s)'.format(route, clients, calls))
+    check(failures, all(status == 200 for status, _body in answers), '{}: all {} clients got 200'.format(route, clients))
+    check(failures, len(set(body for _status, body in answers)) == 1, '{}: all clients got the same payload'.format(route))
+    fresh = answers[0][1]
+
+    # Expire the entry and break upstream, the last payload is served
+    proxy.PROXY_SL_TTL = proxy.PROXY_SRV_TTL = ttl
+    time.sleep(ttl)
+    Upstream.failing = True
+    status, body = get(base, route)
+    check(failures, status == 200 and body == fresh, '{}: failing upstream served stale payload ({})'.format(route, status))
+    status, body = get(base, route)
+    check(failures, status == 200 and upstream_calls(route) == calls + 1,
+        '{}: no upstream call within a TTL of the failure ({} call(s))'.format(route, upstream_calls(route) - calls))
+
+    # Once the payload is older than stale_factor TTLs it is no longer served
+    time.sleep(ttl * stale_factor)
+    status, body = get(base, route)
+    check(failures, status == 502, '{}: payload older than {} TTLs gives 502 ({})'.format(route, stale_factor, status))
+    check(failures, 'error' in json.loads(body.decode('utf-8')), '{}: 502 answer carries the error'.format(route))
+    check(failures, not any(key[0] == route for key in proxy.cache.entries), '{}: the old payload was dropped'.format(route))
+    Upstream.failing = False
+
+
+def main():
+    upstream = start(StubServer(('127.0.0.1', 0), UpstreamHandler))
+    proxy.SL_UPSTREAM = proxy.SRV_UPSTREAM = upstream
+    proxy.REALTIME_API_KEY = 'check'
+    proxy.stale_factor = stale_factor
+    proxy.evict_interval = 0
+    base = start(proxy.ProxyServer(('127.0.0.1', 0), proxy.ProxyHandler))
+    failures = []
+
+    for route in sorted(routes):
+        check_route(failures, base, route)
+
+    if failures:
+        sys.exit('{} check(s) failed'.format(len(failures)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Shared GPIO push button
+#
+# The pin is set up once per process and every press is handed to all
+# registered listeners, so several screens can react to the same button.
+#
+
+try:
+    import RPi.GPIO as GPIO # Import Raspberry Pi GPIO library
+except ImportError: # Not on a Pi, e.g. running against a luma emulator
+    GPIO = None
+
+import metrics
+import recorder
+
+button_gpio_pin = 15
+
+presses = metrics.counter('pisl_button_presses_total', 'Button presses.')
+
+_listeners = []
+_setup_done = False
+
+
+def add_listener(callback):
+    # callback(channel) is called from the GPIO event thread
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+
+def press(channel=button_gpio_pin):
+    # Hand a press to the listeners, also used by replay.py
+    presses.inc()
+    for callback in list(_listeners):
+        callback(channel)
+
+
+def _on_press(channel):
+    recorder.button(channel)
+    press(channel)
+
+
+def setup(pin=button_gpio_pin):
+    global _setup_done
+    if _setup_done:
+        return
+    if GPIO is None:
+        print('RPi.GPIO not available, button disabled')
+        return
+    GPIO.setwarnings(False) # Ignore warning for now
+    GPIO.setmode(GPIO.BOARD) # Use physical pin numbering
+    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # Set pin to be an input pin and set initial value to be pulled low (off)
+    GPIO.add_event_detect(pin, GPIO.RISING, callback=_on_press) # Setup event on pin rising edge
+    _setup_done = True
+
+
+def cleanup():
+    if GPIO is not None:
+        GPIO.cleanup() # Clean up
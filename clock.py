@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Injectable clock
+#
+# Everything that reads the wall clock or sleeps on it goes through here,
+# so replay.py can swap the system clock for a ScaledClock and run a whole
+# day of fetching, rendering and active hours in a couple of minutes.
+# Durations that are only measured (metrics, benchmarks) keep using real
+# time.
+#
+
+import datetime
+import time
+
+
+class SystemClock:
+
+    def now(self):
+        return time.time()
+
+    def wait(self, event, timeout=None):
+        return event.wait(timeout)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class ScaledClock:
+    """
+    A clock starting at epoch second `start` and running `speed` times
+    faster than real time. Waits are shortened by the same factor.
+    """
+
+    def __init__(self, start, speed):
+        self.start = start
+        self.speed = speed
+        self.real_start = time.monotonic()
+
+    def now(self):
+        return self.start + (time.monotonic() - self.real_start) * self.speed
+
+    def wait(self, event, timeout=None):
+        return event.wait(None if timeout is None else timeout / self.speed)
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self.speed)
+
+
+_clock = SystemClock()
+
+
+def install(clock):
+    # Use clock from now on, returns the one it replaces
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def now():
+    # Epoch seconds, like time.time()
+    return _clock.now()
+
+
+def datetime_now():
+    # Local time, like datetime.datetime.now()
+    return datetime.datetime.fromtimestamp(_clock.now())
+
+
+def wait(event, timeout=None):
+    # threading.Event.wait() in clock time
+    return _clock.wait(event, timeout)
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Compact departure store
+#
+# SL realtimedeparturesV4 items are converted once per fetch into small
+# Departure records holding only what is rendered, with the expected time
+# as epoch seconds. Records are kept sorted per journey direction so
+# departed entries can be skipped with a bisect and every frame only needs
+# integer arithmetic. A DepartureView keeps the rows drawn from a store
+# up to date, so frames only read ready-made row strings.
+#
+
+import bisect
+import time
+
+from render_scheduler import next_minute_change
+
+time_format = '%Y-%m-%dT%H:%M:%S'
+
+# The item fields that are used, the rest is dropped right after fetching
+item_fields = ('LineNumber', 'Destination', 'JourneyDirection', 'ExpectedDateTime', 'TimeTabledDateTime',
+    'StopPointNumber', 'JourneyNumber')
+deviation_fields = ('ImportanceLevel', 'Consequence', 'Text')
+
+
+def parse_time(value):
+    # SL times are local time without zone
+    return int(time.mktime(time.strptime(value, time_format)))
+
+
+def trim_items(items):
+    # Keep only the used fields of the JSON items, this is what gets cached
+    trimmed = []
+    for item in items:
+        small = {field: item[field] for field in item_fields if field in item}
+        if item.get('Deviations'):
+            small['Deviations'] = [{field: deviation.get(field) for field in deviation_fields}
+                for deviation in item['Deviations']]
+        trimmed.append(small)
+    return trimmed
+
+
+class Departure:
+
+    __slots__ = ('line', 'destination', 'direction', 'expected', 'deviations')
+
+    def __init__(self, line, destination, direction, expected, deviations=()):
+        self.line = line
+        self.destination = destination
+        self.direction = direction
+        self.expected = expected # Epoch seconds
+        self.deviations = deviations # ((importance, text), ...)
+
+    @classmethod
+    def from_json(cls, item):
+        deviations = tuple(
+            (deviation['ImportanceLevel'], deviation['Consequence'] + ' ' + deviation['Text'])
+            for deviation in item.get('Deviations') or ())
+        expected = item.get('ExpectedDateTime') or item['TimeTabledDateTime']
+        return cls(item['LineNumber'], item['Destination'], item['JourneyDirection'], parse_time(expected), deviations)
+
+    def __repr__(self):
+        return 'Departure({!r}, {!r}, {!r}, {!r})'.format(self.line, self.destination, self.direction, self.expected)
+
+
+class DepartureStore:
+
+    def __init__(self, departures=()):
+        self._departures = {} # direction -> [Departure] sorted by expected
+        self._times = {} # direction -> [expected], for bisect
+        for dep in sorted(departures, key=lambda dep: dep.expected):
+            self._departures.setdefault(dep.direction, []).append(dep)
+        for direction, deps in self._departures.items():
+            self._times[direction] = [dep.expected for dep in deps]
+
+    @classmethod
+    def from_json(cls, items):
+        return cls(Departure.from_json(item) for item in items)
+
+    def directions(self):
+        return sorted(self._departures)
+
+    def upcoming(self, direction, now):
+        # Departures that have not left yet, in time order
+        deps = self._departures.get(direction)
+        if not deps:
+            return ()
+        start = bisect.bisect_left(self._times[direction], now)
+        return deps[start:]
+
+    def __len__(self):
+        return sum(len(deps) for deps in self._departures.values())
+
+
+def minutes_text(expected, now, unit):
+    minutes = (expected - now) // 60
+    return 'Nu' if minutes == 0 else '{}{}'.format(minutes, unit)
+
+
+class ViewRow:
+
+    __slots__ = ('left', 'deps', 'unit', 'right', 'changes_at')
+
+    def __init__(self, left, deps, unit):
+        self.left = left
+        self.deps = deps # The departures counted down on the right
+        self.unit = unit
+        self.right = None
+        self.changes_at = 0
+
+    def update(self, now):
+        self.right = ','.join(minutes_text(dep.expected, now, self.unit) for dep in self.deps)
+        # When a countdown shows a new value (or reaches 'Nu' and leaves)
+        self.changes_at = min(next_minute_change(dep.expected, now) for dep in self.deps)
+
+
+class DepartureView:
+    """
+    The rows shown for a DepartureStore: the first departures in the
+    preferred direction, the other directions grouped per line and
+    destination, and the important deviations. Built once per store, then
+    update() only redoes the countdowns that changed, or regroups when a
+    departure has left.
+    """
+
+    def __init__(self, store, preferred_direction, preferred_count=3, group_count=2, min_importance=4):
+        self.store = store
+        self.preferred_direction = preferred_direction
+        self.preferred_count = preferred_count
+        self.group_count = group_count
+        self.min_importance = min_importance
+        self.preferred = [] # ViewRows
+        self.groups = [] # ViewRows, in direction and departure order
+        self.deviations = () # Deviation texts, each once
+        self.next_preferred = None # Expected time of the first preferred departure
+        self.regroup_at = 0 # When a departure leaves and the rows must be regrouped
+        self.changes_at = 0 # When a row changes next, None when only new data changes them
+
+    def build(self, now):
+        self.preferred = []
+        groups = {}
+        deviations = {} # Ordered set, a deviation is often on every departure
+        self.regroup_at = None
+        for direction in self.store.directions():
+            if direction == 0:
+                continue
+            deps = self.store.upcoming(direction, now)
+            if not deps:
+                continue
+            # The first departure of a direction leaves first
+            leaves_at = deps[0].expected + 1
+            self.regroup_at = leaves_at if self.regroup_at is None else min(self.regroup_at, leaves_at)
+            if direction == self.preferred_direction:
+                deps = deps[:self.preferred_count]
+                for dep in deps:
+                    self.preferred.append(ViewRow(u'{} {}'.format(dep.line, dep.destination), (dep,), ' min'))
+            else:
+                for dep in deps:
+                    groups.setdefault(dep.line + ' ' + dep.destination, []).append(dep)
+            for dep in deps:
+                for importance, text in dep.deviations:
+                    if importance >= self.min_importance:
+                        deviations[text] = True
+        self.groups = [ViewRow(key, tuple(deps[:self.group_count]), 'm') for key, deps in groups.items()]
+        self.deviations = tuple(deviations)
+        self.next_preferred = self.preferred[0].deps[0].expected if self.preferred else None
+        for row in self.preferred + self.groups:
+            row.update(now)
+        self._changes_at()
+
+    def _changes_at(self):
+        times = [row.changes_at for row in self.preferred + self.groups]
+        self.changes_at = min(times) if times else None
+
+    def update(self, now):
+        # Returns True when any row changed
+        if self.changes_at is None or now < self.changes_at:
+            return False
+        if now >= self.regroup_at:
+            self.build(now)
+            return True
+        for row in self.preferred + self.groups:
+            if now >= row.changes_at:
+                row.update(now)
+        self._changes_at()
+        return True
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# On-disk cache of the last successful API payloads
+#
+# Every entry is a small JSON file holding the payload and the time it was
+# fetched. Files are written atomically (temp file + rename) so a power cut
+# never leaves a half written cache behind.
+#
+
+import json
+import os
+import tempfile
+
+import clock
+
+cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cache'))
+
+
+def cache_path(name):
+    return os.path.join(cache_dir, '{}.json'.format(name))
+
+
+def load(name, max_age=None):
+    """
+    Return (payload, fetched_at) for the cached entry, fetched_at being epoch
+    seconds, or None if it is missing, unreadable or older than max_age.
+    """
+    try:
+        with open(cache_path(name), 'r', encoding='utf-8') as file:
+            entry = json.load(file)
+        payload = entry['payload']
+        fetched_at = float(entry['fetched_at'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if max_age is not None and clock.now() - fetched_at > max_age:
+        return None
+    return payload, fetched_at
+
+
+def store(name, payload, fetched_at=None):
+    if fetched_at is None:
+        fetched_at = clock.now()
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.{}.'.format(name), dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump({'fetched_at': fetched_at, 'payload': payload}, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, cache_path(name))
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Background API fetching
+#
+# A FetchScheduler thread runs the fetch functions of its Fetchers and
+# publishes each result as an immutable Snapshot. The render loop only ever
+# reads fetcher.snapshot, so drawing never waits on the network and keeps
+# showing the last good data while a fetch is in flight or failing. Failed
+# fetches are retried according to a retry.RetryPolicy and fetches of an
+# API with a call quota only run while its quota.TokenBucket has calls left.
+#
+# With a cache_name the raw payload of every successful fetch is also kept
+# on disk, so a restarted process can render the cached data right away and
+# only refetch once it is due.
+#
+
+import datetime
+import threading
+import traceback
+from collections import namedtuple
+
+import clock
+import disk_cache
+import metrics
+from helpers import print_log
+
+Snapshot = namedtuple('Snapshot', ['data', 'fetched_at'])
+
+idle_timeout = 30 # Stop fetching when the screen has not used the data for X seconds, > render_scheduler.max_sleep
+
+fetches = metrics.counter('pisl_fetches_total', 'Fetch attempts by source and result.')
+consecutive_failures = metrics.gauge('pisl_fetch_consecutive_failures', 'Failed fetches since the last success.')
+circuit_open = metrics.gauge('pisl_fetch_circuit_open', '1 while the circuit breaker blocks API calls.')
+data_age = metrics.gauge('pisl_data_age_seconds', 'Age of the data shown, in seconds.')
+cache_loads = metrics.counter('pisl_disk_cache_loads_total', 'Disk cache lookups at startup by result.')
+
+
+class Fetcher:
+
+    def __init__(self, name, fetch, delay, retry, parse=None, cache_name=None, max_age=None, budget=None, cost=1):
+        self.name = name
+        self.fetch = fetch # Returns the raw (JSON serializable) payload
+        self.parse = parse # Turns a payload into the data published in snapshots
+        self.cache_name = cache_name
+        self.max_age = max_age # Ignore cached payloads older than X seconds
+        self.delay = delay # Seconds between successful fetches
+        self.retry = retry # RetryPolicy deciding when to retry a failed fetch
+        self.budget = budget # TokenBucket of the API key, None for no quota
+        self.cost = cost # API calls per fetch
+        self.snapshot = None # Last good Snapshot, replaced (never mutated) by the worker
+        self.error = None # Last error, None when the latest fetch succeeded
+        self.next_run = 0
+        self.last_used = None
+        self.scheduler = None
+        if cache_name is not None:
+            self.load_cache()
+        metrics.add_collector(self.collect_metrics)
+
+    def load_cache(self):
+        cached = disk_cache.load(self.cache_name, self.max_age)
+        if cached is None:
+            cache_loads.inc(source=self.name, result='miss')
+            return
+        payload, fetched_at = cached
+        try:
+            data = payload if self.parse is None else self.parse(payload)
+        except Exception as e:
+            cache_loads.inc(source=self.name, result='invalid')
+            print_log('{}: ignoring cache: {}'.format(self.name, e))
+            return
+        cache_loads.inc(source=self.name, result='hit')
+        self.snapshot = Snapshot(data, datetime.datetime.fromtimestamp(fetched_at))
+        # Revalidate in the background once the cached payload is due
+        self.next_run = fetched_at + self.delay
+
+    def use(self, delay=None):
+        # Called by the render loop, keeps the fetcher active
+        if delay is not None:
+            self.set_delay(delay)
+        self.last_used = clock.now()
+        if self.is_due() and self.scheduler is not None:
+            self.scheduler.wake()
+        return self.snapshot
+
+    def set_delay(self, delay):
+        if delay == self.delay:
+            return
+        self.delay = delay
+        if self.snapshot is not None:
+            self.next_run = clock.now() + self.delay - self.age()
+            if self.is_due() and self.scheduler is not None:
+                self.scheduler.wake()
+
+    def refresh(self):
+        # Force a new fetch as soon as possible (e.g. on button press)
+        self.next_run = 0
+        self.last_used = clock.now()
+        if self.scheduler is not None:
+            self.scheduler.wake()
+
+    def age(self):
+        if self.snapshot is None:
+            return None
+        return (clock.datetime_now() - self.snapshot.fetched_at).total_seconds()
+
+    def is_active(self, now=None):
+        if now is None:
+            now = clock.now()
+        return self.last_used is not None and now - self.last_used < idle_timeout
+
+    def is_due(self, now=None):
+        if now is None:
+            now = clock.now()
+        return self.next_run <= now
+
+    def run(self):
+        if not self.retry.allow():
+            # Circuit is open, don't spend API calls until it half opens
+            self.next_run = clock.now() + self.retry.wait_time()
+            return
+        if self.budget is not None and not self.budget.take(self.cost):
+            # Out of API calls, wait until the budget has enough again
+            self.next_run = clock.now() + self.budget.wait_time(self.cost)
+            return
+        try:
+            payload = self.fetch()
+            data = payload if self.parse is None else self.parse(payload)
+        except Exception as e: # Keep the worker alive whatever happens
+            fetches.inc(source=self.name, result='error')
+            self.fail(e)
+            return
+        fetches.inc(source=self.name, result='ok')
+        self.retry.success()
+        fetched_at = clock.now()
+        self.snapshot = Snapshot(data, datetime.datetime.fromtimestamp(fetched_at))
+        self.error = None
+        self.next_run = fetched_at + self.delay
+        if self.cache_name is not None:
+            try:
+                disk_cache.store(self.cache_name, payload, fetched_at)
+            except (OSError, TypeError, ValueError) as e:
+                print_log('{}: cache write failed: {}'.format(self.name, e))
+
+    def collect_metrics(self):
+        age = self.age()
+        if age is not None:
+            data_age.set(round(age, 1), source=self.name)
+        consecutive_failures.set(self.retry.attempt, source=self.name)
+        circuit_open.set(1 if self.retry.wait_time() > 0 else 0, source=self.name)
+
+    def fail(self, e):
+        self.error = e
+        if not self.retry.should_retry(e):
+            # Most likely a bug, log it properly
+            print_log(traceback.format_exc())
+        delay = self.retry.failure(e)
+        self.next_run = clock.now() + delay
+        print_log('{}: {} (retry in {}s, circuit {})'.format(self.name, e, int(delay), self.retry.breaker.state))
+
+
+class FetchScheduler(threading.Thread):
+
+    def __init__(self, on_update=None):
+        threading.Thread.__init__(self, name='fetch-scheduler')
+        self.daemon = True
+        self.fetchers = []
+        self.on_update = on_update # Called with the fetcher after every fetch attempt
+        self._wake = threading.Event()
+
+    def add(self, fetcher):
+        fetcher.scheduler = self
+        self.fetchers.append(fetcher)
+        self.wake()
+        return fetcher
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            now = clock.now()
+            for fetcher in list(self.fetchers):
+                if fetcher.is_active(now) and fetcher.is_due(now):
+                    fetcher.run()
+                    if self.on_update is not None:
+                        self.on_update(fetcher)
+
+            # Sleep until the next active fetcher is due or someone wakes us
+            now = clock.now()
+            timeout = None
+            for fetcher in self.fetchers:
+                if fetcher.is_active(now):
+                    wait = max(0, fetcher.next_run - now)
+                    # Re-check activity once it would time out
+                    wait = min(wait, fetcher.last_used + idle_timeout - now)
+                    timeout = wait if timeout is None else min(timeout, wait)
+            clock.wait(self._wake, timeout)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Frame diffing for the OLED output
+#
+# Keeps the last frame pushed to the device and skips the write when a new
+# frame is identical. For SSD1306 style controllers only the changed 8px high
+# pages are sent, everything else falls back to a full device.display().
+# A MultiFrame pushes every frame to several devices at once, each through
+# its own FrameDiffer.
+#
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from PIL import Image, ImageDraw
+
+from helpers import print_log
+from helpers import process_uptime
+import metrics
+
+PAGE_HEIGHT = 8 # SSD1306 GDDRAM page height in pixels
+
+render_time = metrics.histogram('pisl_frame_render_seconds', 'Time spent drawing a frame, in seconds.')
+push_time = metrics.histogram('pisl_frame_push_seconds', 'Time spent diffing and pushing a frame, in seconds.')
+frames = metrics.counter('pisl_frames_total', 'Frames by how they were pushed (skipped, partial, full, dropped).')
+
+
+class FrameDiffer:
+
+    def __init__(self, device):
+        self.device = device
+        self.size = device.size # Canvas size
+        self.last_frame = None # Last (preprocessed) frame pushed to the device
+        self.frames_skipped = 0
+        self.frames_partial = 0
+        self.frames_full = 0
+        self.first_frame_time = None # Seconds from process start to the first push
+        self.partial_pages = supports_partial_pages(device)
+
+    @contextmanager
+    def canvas(self, background=None):
+        """
+        Drop-in replacement for luma.core.render.canvas that only pushes
+        changed content to the device.
+        """
+        start = time.perf_counter()
+        if background is None:
+            image = Image.new(self.device.mode, self.device.size)
+        else:
+            image = background.copy()
+        yield ImageDraw.Draw(image)
+        render_time.observe(time.perf_counter() - start)
+        self.display(image)
+
+    def invalidate(self):
+        # Force a full push of the next frame, e.g. after device.show()
+        self.last_frame = None
+
+    def display(self, image):
+        with push_time.time():
+            return self._display(image)
+
+    def _display(self, image):
+        if image.mode != self.device.mode:
+            image = image.convert(self.device.mode)
+        frame = self.device.preprocess(image)
+        data = frame.tobytes()
+
+        if self.last_frame is not None and data == self.last_frame:
+            self.frames_skipped += 1
+            frames.inc(result='skipped')
+            return False
+
+        pages = None
+        if self.partial_pages and self.last_frame is not None:
+            pages = dirty_pages(self.last_frame, data, frame.width, frame.height)
+
+        if pages is None or len(pages) == frame.height // PAGE_HEIGHT:
+            # The device preprocesses again, hand it the original image
+            self.device.display(image)
+            self.frames_full += 1
+            frames.inc(result='full')
+        else:
+            push_pages(self.device, frame, pages)
+            self.frames_partial += 1
+            frames.inc(result='partial')
+        self.last_frame = data
+        if self.first_frame_time is None:
+            self.first_frame_time = process_uptime()
+            print_log('First frame after {:.2f}s'.format(self.first_frame_time))
+        return True
+
+
+class MultiFrame:
+    """
+    FrameDiffer for several devices of the same size: a frame is drawn once
+    and pushed to all devices concurrently. With tile the frame is the
+    devices stacked on top of each other and each one shows its own part,
+    otherwise they all show the whole frame. A device still busy with the
+    previous frame only gets the newest one when it is done, so a slow bus
+    drops frames instead of holding up the others.
+    """
+
+    def __init__(self, devices, tile=False):
+        self.devices = devices
+        self.tile = tile
+        self.differs = [FrameDiffer(device) for device in devices]
+        width, height = devices[0].size
+        self.mode = devices[0].mode
+        self.size = (width, height * len(devices)) if tile else (width, height)
+        self.pool = ThreadPoolExecutor(max_workers=len(devices), thread_name_prefix='display')
+        self.lock = threading.Lock()
+        self.pending = {} # index -> newest frame waiting for a busy device
+        self.busy = set() # Indexes of devices being pushed to
+
+    @contextmanager
+    def canvas(self, background=None):
+        start = time.perf_counter()
+        if background is None:
+            image = Image.new(self.mode, self.size)
+        else:
+            image = background.copy()
+        yield ImageDraw.Draw(image)
+        render_time.observe(time.perf_counter() - start)
+        self.display(image)
+
+    def invalidate(self):
+        for differ in self.differs:
+            differ.invalidate()
+
+    def display(self, image):
+        for index, device in enumerate(self.devices):
+            part = image
+            if self.tile:
+                width, height = device.size
+                part = image.crop((0, index * height, width, (index + 1) * height))
+            with self.lock:
+                if index in self.busy:
+                    if index in self.pending:
+                        frames.inc(result='dropped')
+                    self.pending[index] = part
+                    continue
+                self.busy.add(index)
+            self.pool.submit(self._push, index, part)
+
+    def _push(self, index, image):
+        while image is not None:
+            try:
+                self.differs[index].display(image)
+            except Exception as e: # Keep pushing to the device, the bus may recover
+                print_log('Display {}: {}'.format(index, e))
+            with self.lock:
+                image = self.pending.pop(index, None)
+                if image is None:
+                    self.busy.discard(index)
+
+
+def supports_partial_pages(device):
+    # Only the ssd1306 family addresses GDDRAM with COLUMNADDR/PAGEADDR
+    const = getattr(device, '_const', None)
+    return (device.mode == '1'
+        and type(device).__name__ == 'ssd1306'
+        and hasattr(const, 'COLUMNADDR')
+        and hasattr(const, 'PAGEADDR')
+        and hasattr(device, '_colstart'))
+
+
+def dirty_pages(old, new, width, height):
+    # Frames are packed 1-bit rows (PIL mode '1'), compare 8 rows at a time
+    stride = (width + 7) // 8
+    page_size = stride * PAGE_HEIGHT
+    pages = []
+    for page in range(height // PAGE_HEIGHT):
+        start = page * page_size
+        if old[start:start + page_size] != new[start:start + page_size]:
+            pages.append(page)
+    return pages
+
+
+def page_bytes(frame, page):
+    # Convert 8 packed rows into one byte per column, LSB being the top row
+    width = frame.width
+    stride = (width + 7) // 8
+    rows = frame.crop((0, page * PAGE_HEIGHT, width, (page + 1) * PAGE_HEIGHT)).tobytes()
+    buf = bytearray(width)
+    for bit in range(PAGE_HEIGHT):
+        offset = bit * stride
+        value = 1 << bit
+        for x in range(width):
+            if rows[offset + (x >> 3)] & (0x80 >> (x & 7)):
+                buf[x] |= value
+    return buf
+
+
+def push_pages(device, frame, pages):
+    const = device._const
+    # Group consecutive pages so each run needs only one address window
+    runs = []
+    for page in pages:
+        if runs and runs[-1][1] == page - 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+
+    for first, last in runs:
+        buf = bytearray()
+        for page in range(first, last + 1):
+            buf += page_bytes(frame, page)
+        device.command(
+            # Column start/end address
+            const.COLUMNADDR, device._colstart, device._colend - 1,
+            # Page start/end address
+            const.PAGEADDR, first, last)
+        device.data(list(buf))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Pre-rasterised text rows
+#
+# Every character of the (monospace) font is rasterised once into a glyph
+# atlas of 1 byte per pixel rows. A text row is then composed by joining
+# glyph rows as bytes, turned into an 'L' image in one call and blitted
+# into the frame with draw.bitmap(). Composed rows are kept in a small LRU
+# keyed by text, so rows that did not change since the last frame cost a
+# single blit and no FreeType calls at all. A Marquee scrolls text that is
+# too long for its row.
+#
+
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+from helpers import char_size
+
+row_cache_size = 64 # Composed rows to keep
+
+
+class GlyphAtlas:
+
+    def __init__(self, font):
+        self.font = font
+        self.char_width, self.line_height = char_size(font)
+        self.glyphs = {} # char -> tuple of line_height rows of char_width bytes, None if not monospace
+        self.rows = OrderedDict() # text -> 'L' image of the row
+
+    def glyph(self, char):
+        if char not in self.glyphs:
+            glyph = None
+            # Only glyphs taking exactly one cell can be joined
+            if self.font.getlength(char) == self.char_width:
+                image = Image.new('1', (self.char_width, self.line_height))
+                ImageDraw.Draw(image).text((0, 0), char, font=self.font, fill="white")
+                data = image.convert('L').tobytes()
+                w = self.char_width
+                glyph = tuple(data[y * w:(y + 1) * w] for y in range(self.line_height))
+            self.glyphs[char] = glyph
+        return self.glyphs[char]
+
+    def render(self, text):
+        # The row image of text, from the cache when possible
+        image = self.rows.get(text)
+        if image is not None:
+            self.rows.move_to_end(text)
+            return image
+        glyphs = [self.glyph(char) for char in text]
+        size = (max(1, len(text) * self.char_width), self.line_height)
+        if None in glyphs:
+            # Proportional glyph somewhere, let FreeType lay out the row
+            image = Image.new('1', size)
+            ImageDraw.Draw(image).text((0, 0), text, font=self.font, fill="white")
+            image = image.convert('L')
+        else:
+            data = b''.join(b''.join(glyph[y] for glyph in glyphs) for y in range(self.line_height))
+            image = Image.frombytes('L', size, data or bytes(size[0] * size[1]))
+        self.rows[text] = image
+        if len(self.rows) > row_cache_size:
+            self.rows.popitem(last=False)
+        return image
+
+    def text(self, draw, xy, text, fill="white"):
+        # Drop-in for draw.text(xy, text, font=font, fill=fill)
+        if text:
+            draw.bitmap(xy, self.render(text), fill=fill)
+
+
+class Marquee:
+    """
+    Text scrolling through a row one pixel per step. The text is rendered
+    once into a strip holding it twice, so every position is a single crop.
+    """
+
+    def __init__(self, atlas, text, width, start, steps_per_second, gap=4):
+        strip = atlas.render(text + ' ' * gap)
+        self.text = text
+        self.width = width
+        self.period = strip.width
+        self.start = start # Epoch time the text starts at the left edge
+        self.steps_per_second = steps_per_second
+        self.strip = Image.new('L', (self.period + width, strip.height))
+        for x in range(0, self.period + width, self.period):
+            self.strip.paste(strip, (x, 0))
+
+    def steps(self, now):
+        return int((now - self.start) * self.steps_per_second)
+
+    def position(self, now):
+        return self.steps(now) % self.period
+
+    def draw(self, draw, xy, now, fill="white"):
+        x = self.position(now)
+        draw.bitmap(xy, self.strip.crop((x, 0, x + self.width, self.strip.height)), fill=fill)
+
+    def next_step(self, now):
+        # When the text moves next
+        return self.start + float(self.steps(now) + 1) / self.steps_per_second
@@ -3,71 +3,106 @@
 # Copyright (c) 2014-18 Richard Hull and contributors
 # See LICENSE.rst for details.
 
-from PIL import ImageFont
-
 import os.path
 import datetime
 import time
-import croniter
 
 import math
 
+import clock
+import disk_cache
+import logsink
+import reltime
+
+def get_process_start_time():
+    # Linux knows when the process was started, elsewhere use import time
+    try:
+        with open('/proc/self/stat') as stat, open('/proc/stat') as boot:
+            ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+            btime = int([line.split()[1] for line in boot if line.startswith('btime')][0])
+        return btime + ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (OSError, IndexError, ValueError):
+        return time.time()
+
+process_start_time = get_process_start_time()
+
 def make_font(name, size):
+    from PIL import ImageFont
     font_path = os.path.abspath(os.path.join(
         os.path.dirname(__file__), 'fonts', name))
     return ImageFont.truetype(font_path, size)
 
+def char_size(font):
+    # Measuring every glyph takes a while on a Pi Zero, so the result is
+    # cached on disk per font, size and Pillow version
+    import PIL
+    key = '{}:{}:{}'.format(getattr(font, 'path', None), getattr(font, 'size', None), PIL.__version__)
+    cached = disk_cache.load('font_metrics')
+    metrics = cached[0] if cached is not None else {}
+    if key in metrics:
+        return tuple(metrics[key])
+
+    # Find char width & height
+    _cw, _ch = (0, 0)
+    for i in range(32, 128):
+        if hasattr(font, 'getsize'):
+            w, h = font.getsize(chr(i))
+        else: # Pillow >= 10
+            w = int(math.ceil(font.getlength(chr(i))))
+            h = font.getbbox(chr(i))[3]
+        _cw = max(w, _cw)
+        _ch = max(h, _ch)
+
+    metrics[key] = [_cw, _ch]
+    try:
+        disk_cache.store('font_metrics', metrics)
+    except OSError:
+        pass
+    return _cw, _ch
+
+def process_uptime():
+    # Seconds since the process was started
+    return time.time() - process_start_time
+
 def time_diff(dt, absVal=True):
     if type(dt) != datetime.datetime:
         dt = datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
     t1 = time.mktime(dt.timetuple())
-    now = time.mktime(time.localtime())
+    now = int(clock.now())
     diff = t1 - now
     if absVal:
         diff = abs(diff)
     return int(diff)
 
-def tdiff(ts, absVal=True):
-    now = time.mktime(time.localtime())
+def tdiff(ts, absVal=True, now=None):
+    if now is None:
+        now = int(clock.now())
     diff = ts - now
     if absVal:
         diff = abs(diff)
     return int(diff)
 
-def tdiff_text(ts, absVal=True, max_precision=6, short=False):
-    out = []
-    diff = tdiff(ts, absVal)
-    for unit, suffix_plural, suffix, suffix_short in ((3600*24*30*365, 'år', 'år', 'å'), (3600*24*30, 'månader', 'månad', 'm'), (3600*24*7, 'veckor', 'vecka', 'v'), (3600*24, 'dagar', 'dag', 'd'), (3600, 'timmar', 'timme', 't'), (60, 'minuter', 'minut', 'm'), (1, 'sekunder', 'sekund', 's')):
-        if diff >= unit:
-            val = int(math.floor(diff / unit))
-
-            if short:
-                suffix = suffix_short
-            else:
-                if val != 1:
-                    suffix = suffix_plural
-            out.append('{}{}{}'.format(val, '' if short else ' ', suffix))
-            diff -= val * unit
-            max_precision -= 1
-            if max_precision == 0:
-                break
-    if len(out) > 1 and short is False:
-        out[len(out) - 1] = 'och ' + out[len(out) - 1]
-    return ', '.join(out).replace(', och', ' och')
+def tdiff_text(ts, absVal=True, max_precision=6, short=False, now=None):
+    return reltime.relative(ts, now, absVal, max_precision, short)
+
+_active_hours = {}
 
 def is_active_hours(active_hours, limit):
-    now = datetime.datetime.now()
-    cron = croniter.croniter(active_hours, now)
-    next_d = cron.get_next(datetime.datetime)
-    diff = time_diff(next_d)
-    return diff < 120
+    # The schedule is compiled once per expression and limit
+    from schedule import ActiveHours
+    key = (active_hours, limit)
+    if key not in _active_hours:
+        _active_hours[key] = ActiveHours(active_hours, limit)
+    return _active_hours[key].is_active()
 
 def print_log(string=''):
-    content = '[{}] {}'.format(datetime.datetime.today().strftime('%Y-%m-%d %H:%I:%S'), string)
+    now = clock.datetime_now()
+    content = '[{}] {}'.format(now.strftime('%Y-%m-%d %H:%M:%S'), string)
     print(content)
-    with  open("logs/{}.txt".format(datetime.datetime.today().strftime('%Y-%m-%d')), "a") as file:
-        file.write(content + '\n')
-        file.close()
+    # Written to logs/YYYY-MM-DD.txt by a background thread
+    logsink.write(now.strftime('%Y-%m-%d'), content)
 
 class ApiException(Exception):
-	pass
+	def __init__(self, message='', retry_after=None):
+		Exception.__init__(self, message)
+		self.retry_after = retry_after # Seconds the server asked us to wait, if any
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Shared HTTP client for the SL and SRV APIs
+#
+# One pooled requests.Session keeps connections (and TLS sessions) alive
+# between calls, every request has explicit connect/read timeouts and
+# responses carrying ETag/Last-Modified are revalidated with conditional
+# requests.
+#
+
+import datetime
+import email.utils
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from helpers import ApiException
+import clock
+import metrics
+import recorder
+
+connect_timeout = 5 # Seconds to wait for the TCP/TLS connection
+read_timeout = 15 # Seconds to wait between bytes of the response
+
+pool_size = 4 # Keep-alive connections per host
+
+_session = None
+_session_lock = threading.Lock()
+_validators = {} # url -> (etag, last_modified, parsed result)
+
+api_latency = metrics.histogram('pisl_api_request_seconds', 'API request latency including the body, in seconds.')
+api_requests = metrics.counter('pisl_api_requests_total', 'API requests by host and HTTP status.')
+
+# Errors worth retrying, ValueError covers JSON decode failures
+RETRYABLE_ERRORS = (ApiException, requests.ConnectionError, requests.Timeout, requests.HTTPError, ValueError)
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.headers.update({
+                'Accept': 'application/json',
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive',
+            })
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def get_json(url, parse=None, timeout=None):
+    """
+    GET url and return the parsed JSON body, or parse(response) if given.
+    The body is then not read up front, parse can stream it with
+    response.iter_content(). A timeout (seconds) shortens the connect and
+    read timeouts for callers with a deadline.
+
+    When the server supports revalidation and answers 304 Not Modified the
+    previously parsed result is returned again.
+    """
+    headers = {}
+    cached = _validators.get(url)
+    if cached is not None:
+        etag, last_modified, _result = cached
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+
+    timeouts = (connect_timeout, read_timeout)
+    if timeout is not None:
+        timeouts = (min(connect_timeout, timeout), min(read_timeout, timeout))
+
+    host = urlparse(url).hostname
+    start = time.perf_counter()
+    try:
+        resp = get_session().get(url, headers=headers, timeout=timeouts,
+            stream=parse is not None)
+    except Exception as e:
+        api_requests.inc(host=host, status='error')
+        recorder.api(url, error=str(e))
+        raise
+    api_requests.inc(host=host, status=resp.status_code)
+    try:
+        if resp.status_code != 200 or recorder.enabled():
+            # Read the (short) body, so a streamed connection can be reused,
+            # or the whole body to record it
+            resp.content
+            if resp.status_code != 304 or cached is None:
+                recorder.api(url, resp.status_code, resp.content.decode(resp.encoding or 'utf-8', 'replace'))
+
+        if resp.status_code == 304 and cached is not None:
+            recorder.api(url, 304)
+            return cached[2]
+
+        if resp.status_code != 200:
+            # This means something went wrong.
+            raise ApiException('HTTP return code is not 200: {}'.format(resp.status_code),
+                retry_after=parse_retry_after(resp.headers.get('Retry-After')))
+
+        result = resp.json() if parse is None else parse(resp)
+    finally:
+        # Hand the connection back to the pool
+        resp.close()
+        api_latency.observe(time.perf_counter() - start, host=host)
+
+    etag = resp.headers.get('ETag')
+    last_modified = resp.headers.get('Last-Modified')
+    if etag is not None or last_modified is not None:
+        _validators[url] = (etag, last_modified, result)
+    else:
+        _validators.pop(url, None)
+    return result
+
+
+def parse_retry_after(value):
+    # Retry-After is either delta seconds or an HTTP date
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        until = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=datetime.timezone.utc)
+    return max(0, (until - datetime.datetime.fromtimestamp(clock.now(), datetime.timezone.utc)).total_seconds())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Streaming JSON extraction
+#
+# Pulls the values of a few object keys out of a large JSON document while
+# it is read in chunks, without decoding the rest of it. The keys are found
+# with a regex search and only their values are decoded (by the C decoder
+# of the json module), so nothing else in the document is ever built and
+# consumed chunks are dropped as we go.
+#
+
+import codecs
+import json
+import re
+
+chunk_size = 16*1024 # Bytes read from the response per chunk
+
+_decoder = json.JSONDecoder()
+_space = ' \t\r\n'
+
+
+def _before(buf, start):
+    # Index of the last non-whitespace character before start, -1 if none
+    i = start - 1
+    while i >= 0 and buf[i] in _space:
+        i -= 1
+    return i
+
+
+def _is_key(buf, start):
+    # A real key is preceded by '{' or ',', a match inside a string is not
+    i = _before(buf, start)
+    return i >= 0 and buf[i] in '{,'
+
+
+def extract(chunks, keys):
+    """
+    Return {key: value} for the given object keys, read from the JSON
+    document in chunks (bytes or str). keys maps each key to None or a
+    function applied to its value. Keys are matched at any depth, so they
+    should be unique in the document, the first occurrence is used.
+    """
+    pattern = re.compile(r'"(' + '|'.join(re.escape(key) for key in keys) + r')"\s*:\s*')
+    tail = max(len(key) for key in keys) + 16 # Enough to hold a key split over two chunks
+    chunks = iter(chunks)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    need = 0 # Buffer length to wait for before decoding a value again
+    result = {}
+
+    while len(result) < len(keys):
+        m = pattern.search(buf, pos)
+        if m is not None and m.end() < len(buf) and (len(buf) >= need or eof):
+            if m.group(1) in result or not _is_key(buf, m.start()):
+                pos = m.end()
+                continue
+            try:
+                value, end = _decoder.raw_decode(buf, m.end())
+            except ValueError:
+                if eof:
+                    raise
+                # The value continues in later chunks, wait for twice as
+                # much so a long value is not decoded over and over
+                need = 2 * len(buf) - m.start()
+            else:
+                if end == len(buf) and not eof:
+                    # A number may go on in the next chunk
+                    need = len(buf) + 1
+                    continue
+                convert = keys[m.group(1)]
+                result[m.group(1)] = value if convert is None else convert(value)
+                pos = end
+                need = 0
+                continue
+        elif eof:
+            break
+        # Drop what is consumed, keeping a (partial) key and what precedes it
+        start = m.start() if m is not None else max(pos, len(buf) - tail)
+        keep = max(0, _before(buf, start))
+        buf = buf[keep:]
+        pos = max(0, pos - keep)
+        need = max(0, need - keep)
+        chunk = next(chunks, None)
+        if chunk is None:
+            buf += decoder.decode(b'', final=True)
+            eof = True
+        else:
+            buf += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+    # Read to the end, so the connection can be reused
+    for _chunk in chunks:
+        pass
+    return result
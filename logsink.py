@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Buffered log file writer
+#
+# print_log() lines are queued and written in batches by a background
+# thread, so the render loop never waits on the SD card. Day files
+# (logs/YYYY-MM-DD.txt) are rotated when they grow too big, gzipped once
+# the day is over and removed when they get too old.
+#
+
+import atexit
+import datetime
+import gzip
+import os
+import queue
+import re
+import shutil
+import threading
+
+log_dir = 'logs'
+flush_delay = 5 # Write queued lines at least every X seconds...
+flush_lines = 200 # ...or as soon as this many are queued
+max_file_size = 1024*1024 # Rotate a day file when it grows beyond X bytes
+max_age_days = 60 # Remove compressed logs older than X days
+
+_log_file = re.compile(r'^(\d{4}-\d{2}-\d{2})(\.\d+)?\.txt(\.gz)?$')
+
+
+class LogWriter(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='log-writer')
+        self.daemon = True
+        self.queue = queue.Queue()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock() # Held while writing, flush() may run from atexit
+        self.day = None
+
+    def write(self, day, line):
+        self.queue.put((day, line))
+        if self.queue.qsize() >= flush_lines:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(flush_delay)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        # Lines stay queued until written, so atexit can flush what is left
+        with self.lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                self.write_batch(batch)
+
+    def write_batch(self, batch):
+        try:
+            os.makedirs(log_dir, exist_ok=True)
+            by_day = {}
+            for day, line in batch:
+                by_day.setdefault(day, []).append(line)
+            for day, lines in sorted(by_day.items()):
+                if day != self.day:
+                    self.day = day
+                    self.cleanup(day)
+                path = os.path.join(log_dir, '{}.txt'.format(day))
+                self.rotate(path, day)
+                with open(path, 'a', encoding='utf-8') as file:
+                    file.write(''.join(lines))
+        except OSError as e:
+            print('Log write failed: {}'.format(e))
+
+    def rotate(self, path, day):
+        try:
+            if os.path.getsize(path) < max_file_size:
+                return
+        except OSError:
+            return
+        n = 1
+        while os.path.exists(os.path.join(log_dir, '{}.{}.txt'.format(day, n))):
+            n += 1
+        os.rename(path, os.path.join(log_dir, '{}.{}.txt'.format(day, n)))
+
+    def cleanup(self, today):
+        # Compress finished days and remove old ones
+        oldest = (datetime.datetime.strptime(today, '%Y-%m-%d') - datetime.timedelta(days=max_age_days)).strftime('%Y-%m-%d')
+        for name in os.listdir(log_dir):
+            m = _log_file.match(name)
+            if m is None or m.group(1) >= today:
+                continue
+            path = os.path.join(log_dir, name)
+            if m.group(1) < oldest:
+                os.remove(path)
+            elif m.group(3) is None:
+                with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(path)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter()
+            _writer.start()
+            atexit.register(_writer.flush)
+    return _writer
+
+
+def write(day, line):
+    get_writer().write(day, line + '\n')
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Built-in metrics
+#
+# Counters, gauges and histograms in the Prometheus text format, exported
+# as a textfile (for the node_exporter textfile collector) and/or served on
+# a tiny local HTTP endpoint:
+#
+#   METRICS_TEXTFILE=/var/lib/node_exporter/textfile_collector/pisl.prom
+#   METRICS_PORT=9105
+#   METRICS_ADDRESS=127.0.0.1   Set to 0.0.0.0 to be scraped from elsewhere
+#
+
+import math
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+export_interval = 15 # Write the textfile every X seconds
+
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {} # Sorted label tuple -> value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(labels), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=default_buckets):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(labels, ('le', _format_value(bound))), count))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(labels), _format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(labels), counts[-1]))
+        return lines
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = [] # Called before every export to refresh gauges
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=default_buckets):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                print('Metrics collector failed: {}'.format(e))
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+add_collector = registry.add_collector
+
+
+def resident_memory():
+    # Current RSS in bytes, peak RSS where /proc is missing
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _collect_process():
+    from helpers import process_uptime
+    gauge('pisl_process_resident_memory_bytes', 'Resident memory size in bytes.').set(resident_memory())
+    gauge('pisl_process_uptime_seconds', 'Seconds since the process was started.').set(round(process_uptime(), 3))
+
+
+registry.add_collector(_collect_process)
+
+
+def write_textfile(path):
+    # Atomic, so the textfile collector never reads half a file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.pisl-metrics.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(registry.render())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep scrapes out of the console
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address='127.0.0.1'):
+    server = _ThreadingHTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _export_loop(path):
+    while True:
+        try:
+            write_textfile(path)
+        except OSError as e:
+            print('Metrics textfile write failed: {}'.format(e))
+        time.sleep(export_interval)
+
+
+def start_exporter():
+    """
+    Start exporting as configured by METRICS_TEXTFILE, METRICS_PORT and
+    METRICS_ADDRESS, does nothing when neither file nor port is set.
+    """
+    path = os.getenv("METRICS_TEXTFILE")
+    port = os.getenv("METRICS_PORT")
+    if port:
+        start_http_server(int(port), os.getenv("METRICS_ADDRESS", "127.0.0.1"))
+    if path:
+        thread = threading.Thread(target=_export_loop, args=(path,), name='metrics-textfile')
+        thread.daemon = True
+        thread.start()
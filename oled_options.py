@@ -65,3 +65,20 @@ def get_device(actual_args=None):
         parser.error(e)
 
     return device
+
+
+def get_devices(actual_args=None):
+    """
+    Create one device per group of command-line arguments, groups being
+    separated by a lone '+', e.g.
+    --display ssd1306 --i2c-port 1 + --display ssd1306 --i2c-port 3
+    """
+    if actual_args is None:
+        actual_args = sys.argv[1:]
+    groups = [[]]
+    for arg in actual_args:
+        if arg == '+':
+            groups.append([])
+        else:
+            groups[-1].append(arg)
+    return [get_device(group) for group in groups]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# SRV pickup calendar
+#
+# The sewagePickup results are converted once per fetch into Pickup records
+# holding the pickup time as epoch seconds and the parts of the row that
+# never change. The records are kept sorted so past pickups are skipped with
+# a bisect, and only the "2d3t" part of a row is rendered while drawing.
+# That part comes from reltime's cache, keyed on the pickup time rather than
+# held by the record, so it survives the records being rebuilt on a refetch.
+#
+
+import bisect
+import re
+import time
+
+import reltime
+
+date_pattern = re.compile(r'(?P<year>\d+)-(?P<month>\d+)-(?P<day>\d+)')
+pickup_hour = 9 # The calendar only has dates, count down to X o'clock
+relative_precision = 2 # Units in the relative time, e.g. 2d3t
+
+# Shortened container types, the full ones don't fit a row
+container_replacements = ((u'Kärl 370 liter kärl', 'K'), (u' restavfall', ''), (u' färgsortering', ''))
+
+
+def container_label(container_type):
+    for old, new in container_replacements:
+        container_type = container_type.replace(old, new)
+    return container_type
+
+
+def parse_date(iso_date):
+    # Returns (epoch seconds of the pickup, 'd/m' label)
+    m = date_pattern.search(iso_date)
+    year, month, day = int(m.group('year')), int(m.group('month')), int(m.group('day'))
+    ts = int(time.mktime((year, month, day, pickup_hour, 0, 0, 0, 0, -1)))
+    return ts, '{}/{}'.format(day, month)
+
+
+class Pickup:
+
+    __slots__ = ('ts', 'container', 'date_label', '_prefix')
+
+    def __init__(self, ts, container, date_label):
+        self.ts = ts # Epoch seconds
+        self.container = container # Shortened container type
+        self.date_label = date_label # e.g. '3/11'
+        self._prefix = u'{} {}{} '.format(container, date_label, ' ' * (5 - len(date_label)))
+
+    def row(self, relative):
+        return self._prefix + relative.replace(' ', '')
+
+    def __repr__(self):
+        return 'Pickup({!r}, {!r}, {!r})'.format(self.ts, self.container, self.date_label)
+
+
+class PickupCalendar:
+
+    def __init__(self, pickups=()):
+        self._pickups = sorted(pickups, key=lambda pickup: pickup.ts)
+        self._times = [pickup.ts for pickup in self._pickups]
+
+    @classmethod
+    def from_json(cls, results):
+        dates = {} # startDate -> (ts, label), most containers share dates
+        pickups = []
+        for result in results:
+            for container in result['containers']:
+                label = container_label(container['containerType'])
+                for date in container['calendars']:
+                    start = date['startDate']
+                    if start not in dates:
+                        dates[start] = parse_date(start)
+                    ts, date_label = dates[start]
+                    pickups.append(Pickup(ts, label, date_label))
+        return cls(pickups)
+
+    def upcoming(self, now):
+        # Pickups that are not in the past, in time order
+        start = bisect.bisect_left(self._times, int(now))
+        return self._pickups[start:]
+
+    def __len__(self):
+        return len(self._pickups)
+
+
+def rows(pickups, now):
+    # The row texts of pickups at epoch second now, and when one changes next
+    relatives, changes_at = reltime.relative_many([pickup.ts for pickup in pickups], now,
+        max_precision=relative_precision, short=True)
+    return [pickup.row(relative) for pickup, relative in zip(pickups, relatives)], changes_at
@@ -2,23 +2,39 @@
 # -*- coding: utf-8 -*-
 #
 
-import requests
-import datetime
-import time
 import os
-import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 from helpers import make_font
+from helpers import char_size
+from glyphs import GlyphAtlas
+from glyphs import Marquee
 from helpers import time_diff
-from helpers import is_active_hours
 from helpers import ApiException
-from requests import ReadTimeout, ConnectTimeout, HTTPError, Timeout, ConnectionError
+from helpers import print_log
+from schedule import ActiveHours
+from departures import DepartureStore
+from departures import DepartureView
+from departures import trim_items
+from fetcher import Fetcher
+from fetcher import FetchScheduler
+from render_scheduler import RenderScheduler
+from render_scheduler import earliest
+from render_scheduler import next_step
+from retry import RetryPolicy
+from retry import CircuitBreaker
+from quota import RefreshPlanner
+from quota import get_bucket
+import http_client
+import jsonstream
 
 from oled_options import get_device
-from luma.core.render import canvas
-from PIL import ImageFont
-from dateutil.parser import parse
-import RPi.GPIO as GPIO # Import Raspberry Pi GPIO library
+from framediff import FrameDiffer
+import button
+import clock
+import metrics
 
 from dotenv import load_dotenv
 
@@ -26,11 +42,20 @@ load_dotenv(dotenv_path='.env')
 
 data_refresh_delay_normal = 120 # Normal API frefresh fequency
 data_refresh_delay_fast = 30 # A faster API refresh freqency
-
-screen_data_refresh_delay = 5 # Redraw (cached) data every X seconds
+data_refresh_delay_slow = 60*5 # Refresh frequency when nothing is about to happen
+departure_soon = 60*5 # Refresh fast when the next departure is within X seconds...
+departure_far = 60*20 # ...and slow when it is further away than X seconds
+data_retry_delay = 30 # First retry of a failed API call within X seconds, doubling for every failure
+data_retry_delay_max = 60*15 # Never wait longer than X seconds between retries
+api_failure_threshold = 5 # Stop calling the API after X consecutive failures...
+api_circuit_reset_time = 60*15 # ...for X seconds
+fetch_deadline = 10 # Give up on sites that have not answered within X seconds, show the others
+
+data_age_resolution = 5 # Show the data age in steps of X seconds
+marquee_speed = 25 # Scroll deviations that don't fit at X pixels (and frames) per second
 screen_active_time = 120 # How long the screen is active after button press (during off-hours)
 
-start_time = datetime.datetime.now()
+start_time = clock.datetime_now()
 
 row = 0
 max_rows = 0
@@ -38,39 +63,48 @@ font_size = 15
 width = 0
 height = 0
 line_height = 0
-button_gpio_pin = 15
+atlas = None
+marquee = None
 
-last_get_deps = None
 button_press_time = None
-departures = None
+active_hours = None
+next_redraw_at = None
+deps_fetcher = None
+deps_view = None
+refresh_planner = None
+site_pool = None
 
 REALTIME_API_KEY = os.getenv("REALTIME_API_KEY")
+SL_API_BASE = os.getenv("SL_API_BASE") # e.g. a local proxy.py, the key is then optional
 
 PREFERRED_JOURNEY_DIRECTION = os.getenv("PREFERRED_JOURNEY_DIRECTION") # SL API direction to draw fully
 PREFERRED_JOURNEY_DIRECTION = int(PREFERRED_JOURNEY_DIRECTION)
 
 TRANSPORT_TYPE = os.getenv("TRANSPORT_TYPE")
+TRANSPORT_TYPES = [t.strip() for t in os.getenv("TRANSPORT_TYPES", TRANSPORT_TYPE or '').split(',') if t.strip()] # e.g. Metros,Buses
 
 SL_SITE_ID = os.getenv("SL_SITE_ID")
 #Sätra = 9288
 #Liljeholmen = 9294
+SL_SITE_IDS = [s.strip() for s in os.getenv("SL_SITE_IDS", SL_SITE_ID or '').split(',') if s.strip()] # e.g. 9288,9294
 
 ACTIVE_HOURS = os.getenv("ACTIVE_HOURS")
 
+SL_CACHE_MAX_AGE = int(os.getenv("SL_CACHE_MAX_AGE", 1800)) # Don't start from cached departures older than X seconds
+
+SL_API_QUOTA = os.getenv("SL_API_QUOTA") # API calls allowed per SL_API_QUOTA_PERIOD for the key, unset for no limit
+SL_API_QUOTA_PERIOD = int(os.getenv("SL_API_QUOTA_PERIOD", 3600*24*30)) # Seconds
+SL_API_QUOTA_BURST = os.getenv("SL_API_QUOTA_BURST") # Calls that can be saved up, a day of calls by default
+
 def button_callback(channel):
     global button_press_time
     # Set button press time
-    button_press_time = datetime.datetime.now()
+    button_press_time = clock.datetime_now()
     # Force API refresh
-    last_get_deps = None
+    if deps_fetcher is not None:
+        deps_fetcher.refresh()
     print("Button was pushed!")
 
-def button_setup():
-    GPIO.setwarnings(False) # Ignore warning for now
-    GPIO.setmode(GPIO.BOARD) # Use physical pin numbering
-    GPIO.setup(button_gpio_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # Set pin to be an input pin and set initial value to be pulled low (off)
-    GPIO.add_event_detect(button_gpio_pin,GPIO.RISING,callback=button_callback) # Setup event on pin rising edge
-
 def print_out(left_text='', right_text='', draw=None):
     global row
     if draw is None:
@@ -86,157 +120,235 @@ def print_out(left_text='', right_text='', draw=None):
 
         y = row * line_height
         row += 1
-        draw.text((0, y), left_text + ' ' + right_text, font=font, fill="white")
-
-def get_departures():
+        atlas.text(draw, (0, y), left_text + ' ' + right_text)
+
+def read_site(resp):
+    # Stream the response, only the configured transport types are decoded
+    keys = {'StatusCode': None, 'Message': None}
+    for transport_type in TRANSPORT_TYPES:
+        keys[transport_type] = trim_items
+    return jsonstream.extract(resp.iter_content(jsonstream.chunk_size), keys)
+
+def print_marquee(text, draw):
+    # Scroll text that does not fit through its row, returns when it moves next
+    global row, marquee
+    if len(text) < max_chars:
+        print_out(text, draw=draw)
+        return None
+    now = clock.now()
+    if marquee is None or marquee.text != text:
+        marquee = Marquee(atlas, text, width, now, marquee_speed)
+    marquee.draw(draw, (0, row * line_height), now)
+    row += 1
+    return marquee.next_step(now)
+
+def fetch_site(site_id, deadline=None):
+    # deadline: time.monotonic() the answer is no longer waited for
+    url = "%s/api2/realtimedeparturesV4.json?key=%s&siteid=%s&timewindow=30" % (SL_API_BASE or "http://api.sl.se", REALTIME_API_KEY, site_id)
+    timeout = None
+    if deadline is not None:
+        timeout = max(1, deadline - time.monotonic())
+    json = http_client.get_json(url, parse=read_site, timeout=timeout)
+
+    if(json.get('StatusCode') != 0):
+        raise ApiException('Status code is not 0: {} {}'.format(json.get('StatusCode'), json.get('Message') or ''))
+
+    items = []
+    for transport_type in TRANSPORT_TYPES:
+        items.extend(json.get(transport_type) or ())
+    return items
+
+def departure_key(item):
+    # Overlapping sites list the same departure from the same stop point
+    return (item.get('StopPointNumber'), item['LineNumber'], item.get('JourneyNumber'), item.get('TimeTabledDateTime'))
+
+def merge_departures(results):
+    merged = []
+    seen = set()
+    for items in results:
+        for item in items:
+            key = departure_key(item)
+            if key not in seen:
+                seen.add(key)
+                merged.append(item)
+    return merged
+
+def fetch_departures():
     print('Making API call...')
-    
-    url = "http://api.sl.se/api2/realtimedeparturesV4.json?key=%s&siteid=%s&timewindow=30" % (REALTIME_API_KEY, SL_SITE_ID)
-    resp = requests.get(url)
-
-    if resp.status_code != 200:
-        # This means something went wrong.
-        raise ApiException('HTTP return code is not 200: {}'.format(resp.status_code))
-    json = resp.json()
 
-    if(json['StatusCode'] != 0):
-        raise ApiException('Status code is not 0: {}'.format(json['StatusCode']))
+    # All sites at once, so a refresh takes as long as the slowest site
+    deadline = time.monotonic() + fetch_deadline
+    futures = [site_pool.submit(fetch_site, site_id, deadline) for site_id in SL_SITE_IDS]
+    wait(futures, timeout=fetch_deadline)
+
+    results = []
+    errors = []
+    for site_id, future in zip(SL_SITE_IDS, futures):
+        if not future.done():
+            future.cancel()
+            errors.append('{}: no answer within {}s'.format(site_id, fetch_deadline))
+        elif future.exception() is not None:
+            errors.append('{}: {}'.format(site_id, future.exception()))
+        else:
+            results.append(future.result())
+    if not results:
+        # Nothing to show, let the retry policy handle it
+        if len(futures) == 1 and futures[0].done() and not futures[0].cancelled():
+            raise futures[0].exception()
+        raise ApiException('All sites failed: {}'.format('; '.join(errors)))
+    if errors:
+        # Show what we got, the missing sites are fetched again next refresh
+        print_log('SL partial result, {}'.format('; '.join(errors)))
+    return merge_departures(results)
+
+def parse_departures(items):
+    # Convert once per fetch, frames then only do integer arithmetic
+    return DepartureStore.from_json(items)
 
-    data = json['ResponseData']
-    transport_type = data[TRANSPORT_TYPE]
-    departures = {1: [], 2: [], 0: []}
-    for item in transport_type:
-        departures[item['JourneyDirection']].append(item)
+def get_departures():
+    return parse_departures(fetch_departures())
 
-    return departures
+def wanted_refresh_delay(delay, next_departure, deviations, now):
+    # Refresh more often when it matters and less when nothing is about to happen
+    if deviations or (next_departure is not None and next_departure - now < departure_soon):
+        return min(delay, data_refresh_delay_fast)
+    if delay > data_refresh_delay_fast and (next_departure is None or next_departure - now > departure_far):
+        return max(delay, data_refresh_delay_slow)
+    return delay
 
 def draw_deps(draw, data_refresh_delay):
-    global row
-    global last_get_deps
-    global departures
-    if departures is None or time_diff(last_get_deps) > data_refresh_delay:
-        try:
-            departures = get_departures()
-        except ApiException as e:
-            print_out (str(e), '', draw=draw)
-            time.sleep(data_refresh_delay_fast) # 30s
-            return
-        except (ConnectionError, ConnectTimeout, HTTPError, ReadTimeout, Timeout) as e:
-            print_out (str(e), '', draw=draw)
-            time.sleep(data_refresh_delay_fast) # 30s
-            return
-        except ValueError as e: # Can be internet connection failure
-            print_out (str(e), '', draw=draw)
-            time.sleep(data_refresh_delay_fast * 10) # 5m
-            return 
-        last_get_deps = datetime.datetime.now()
-    
-    print_buffer = {}
-    deviations_shown = []
-    preferred_num_printed = 0
-
-    for di, deps in departures.items():
-        if di == 0:
-            continue
-
-        for dep in deps:
-            diff = time_diff(dep['ExpectedDateTime'], absVal=False)
-            if diff < 0:
-                continue
-            est_min = int(math.floor(diff / 60))
-            if est_min == 0:
-                est_min = 'Nu'
-            else:
-                est_min = '{} min'.format(est_min)
-            # Print full list, if it is the preferred dir
-            if di == PREFERRED_JOURNEY_DIRECTION:
-                # Only print 3
-                if preferred_num_printed == 3:
-                    continue
-                print_out(u'{} {}'.format(dep['LineNumber'], dep['Destination']), '{}'.format(est_min), draw=draw)
-                preferred_num_printed += 1
-
-            else:
-                key = u''.join(dep['LineNumber'] + ' ' + dep['Destination'])
-                if key not in print_buffer:
-                    print_buffer[key] = []
-                print_buffer[key].append(dep)
-
-            # Look for deviations and collect them
-            if dep['Deviations'] is not None:
-                for deviation in dep['Deviations']:
-                    if deviation['ImportanceLevel'] > 3:
-                        deviations_shown.append(deviation['Consequence'] + ' ' + deviation['Text'])
+    # Returns when the drawn content changes next, None if only new data changes it
+    global row, deps_view
+    snapshot = deps_fetcher.use()
+    if snapshot is None:
+        deps_fetcher.set_delay(refresh_planner.plan(data_refresh_delay))
+        if deps_fetcher.error is not None:
+            print_out(str(deps_fetcher.error), '', draw=draw)
+        else:
+            print_out('Loading...', '', draw=draw)
+        row = 0
+        return None
+    if deps_view is None or deps_view.store is not snapshot.data:
+        deps_view = DepartureView(snapshot.data, PREFERRED_JOURNEY_DIRECTION)
+    now = int(clock.now())
+    deps_view.update(now)
+    changes_at = None
+
+    # Print full list of the preferred direction
+    for view_row in deps_view.preferred:
+        print_out(view_row.left, view_row.right, draw=draw)
+        changes_at = earliest(changes_at, view_row.changes_at)
+
     # Print deviations
-    if deviations_shown:
-        print_out(u'{}'.format(', '.join(deviations_shown)), draw=draw)
+    if deps_view.deviations:
+        changes_at = earliest(changes_at, print_marquee(u'{}'.format(', '.join(deps_view.deviations)), draw))
     else:
-        print_out('', 'Data age: {}s'.format(time_diff(last_get_deps)), draw=draw)
-
-    # Empty the print buffer for printing low prio deps last
-    if print_buffer:
-
-        if row + len(print_buffer) < max_rows:
-            row += (max_rows - row - len(print_buffer))
-        for dest, deps in print_buffer.items():
-            temp = []
-            for dep in deps:
-                diff = time_diff(dep['ExpectedDateTime'], absVal=False)
-                if diff < 0:
-                    continue
-                est_min = int(math.floor(diff / 60))
-                if est_min == 0:
-                    est_min = 'Nu'
-                else:
-                    est_min = '{}m'.format(est_min)
-                #temp.append('{} [{}]'.format(dep['DisplayTime'], est_min))
-                temp.append(est_min)
-                if len(temp) == 2:
-                    break
-
-            print_out(u'{}'.format(dest), '{}'.format(','.join(temp)), draw=draw)
+        fetched_at = int(snapshot.fetched_at.timestamp())
+        age = now - fetched_at
+        print_out('', 'Data age: {}s'.format(age - age % data_age_resolution), draw=draw)
+        changes_at = earliest(changes_at, next_step(fetched_at, data_age_resolution, now))
+
+    # Print low prio deps last, at the bottom
+    if deps_view.groups:
+        if row + len(deps_view.groups) < max_rows:
+            row += (max_rows - row - len(deps_view.groups))
+        for view_row in deps_view.groups:
+            print_out(view_row.left, view_row.right, draw=draw)
+            changes_at = earliest(changes_at, view_row.changes_at)
             if row == max_rows:
                 break
     row = 0
+    deps_fetcher.set_delay(refresh_planner.plan(
+        wanted_refresh_delay(data_refresh_delay, deps_view.next_preferred, deps_view.deviations, now)))
+    return changes_at
+
+
+def draw_screen(draw):
+    global next_redraw_at
+    # Only draw if started recently
+    if time_diff(start_time) < screen_active_time:
+        changes_at = draw_deps(draw, data_refresh_delay_normal)
+        active_until = start_time.timestamp() + screen_active_time
+    # Or only draw if active hours
+    elif active_hours is not None and active_hours.is_active():
+        changes_at = draw_deps(draw, data_refresh_delay_normal)
+        active_until = active_hours.next_change()
+    # Or if button is pressed recently
+    elif button_press_time is not None and time_diff(button_press_time) < screen_active_time:
+        changes_at = draw_deps(draw, data_refresh_delay_fast)
+        active_until = button_press_time.timestamp() + screen_active_time
+    else:
+        next_redraw_at = next_change()
+        return False
+    next_redraw_at = earliest(changes_at, active_until)
+    return True
+
+def next_redraw():
+    # When the screen content can change next, None if only events change it
+    return next_redraw_at
+
+def next_change():
+    # When the screen turns on by itself, None if only the button can do it
+    if active_hours is None:
+        return None
+    return active_hours.next_change()
+
+def setup(size, screen_font, fetch_scheduler):
+    global width, height, font, max_chars, line_height, max_rows, start_time, active_hours, deps_fetcher, site_pool
+    global refresh_planner, atlas
+    if not SL_SITE_IDS:
+        exit("SL_SITE_ID or SL_SITE_IDS env missing.")
+    if not TRANSPORT_TYPES:
+        exit("TRANSPORT_TYPE or TRANSPORT_TYPES env missing.")
+    if REALTIME_API_KEY is None and SL_API_BASE is None:
+        exit("REALTIME_API_KEY env missing.")
+    width, height = size
+    font = screen_font
+    atlas = GlyphAtlas(font)
+    char_width, line_height = char_size(font)
+    max_chars = width // char_width
+    max_rows = height // line_height
+    start_time = clock.datetime_now()
+    if ACTIVE_HOURS is not None:
+        active_hours = ActiveHours(ACTIVE_HOURS, screen_active_time)
+    retry = RetryPolicy(data_retry_delay, data_retry_delay_max, retry_on=http_client.RETRYABLE_ERRORS,
+        breaker=CircuitBreaker(api_failure_threshold, api_circuit_reset_time))
+    budget = None
+    if SL_API_QUOTA is not None:
+        burst = int(SL_API_QUOTA_BURST) if SL_API_QUOTA_BURST is not None else None
+        budget = get_bucket(REALTIME_API_KEY, int(SL_API_QUOTA), SL_API_QUOTA_PERIOD, burst)
+    # Every refresh calls the API once per site
+    refresh_planner = RefreshPlanner('SL', budget, cost=len(SL_SITE_IDS))
+    # Room for a round of requests still trickling in past the deadline,
+    # so they don't hold up the next round
+    site_pool = ThreadPoolExecutor(max_workers=2 * len(SL_SITE_IDS), thread_name_prefix='sl-site')
+    deps_fetcher = fetch_scheduler.add(Fetcher('SL', fetch_departures, data_refresh_delay_normal, retry,
+        parse=parse_departures, cache_name='sl_{}_{}'.format('-'.join(SL_SITE_IDS), '-'.join(TRANSPORT_TYPES)),
+        max_age=SL_CACHE_MAX_AGE, budget=budget, cost=len(SL_SITE_IDS)))
+    button.add_listener(button_callback)
 
 def main():
 
     while True:
-        with canvas(device) as draw:
-            # Only draw if started recently
-            if time_diff(start_time) < screen_active_time:
-                draw_deps(draw, data_refresh_delay_normal)
-            # Or only draw if active hours
-            elif ACTIVE_HOURS is not None and is_active_hours(ACTIVE_HOURS, screen_active_time):
-                draw_deps(draw, data_refresh_delay_normal)
-            # Or if button is pressed recently
-            elif button_press_time is not None and time_diff(button_press_time) < screen_active_time:
-                draw_deps(draw, data_refresh_delay_fast)
-        time.sleep(screen_data_refresh_delay)
+        with frame.canvas() as draw:
+            draw_screen(draw)
+        # Sleep until something visible changes, new data or a button press
+        render_scheduler.wait_until(next_redraw_at)
 
 if __name__ == "__main__":
-    if SL_SITE_ID is None:
-        exit("SL_SITE_ID env missing.")
-    if REALTIME_API_KEY is None:
-        exit("REALTIME_API_KEY env missing.")
     try:
         device = get_device()
-        width = device.width
-        height = device.height
-        font = make_font("ProggyTiny.ttf", font_size)
-        # Find char width & height
-        _cw, _ch = (0, 0)
-        for i in range(32, 128):
-            w, h = font.getsize(chr(i))
-            _cw = max(w, _cw)
-            _ch = max(h, _ch)
-        max_chars = width // _cw
-        line_height = _ch
-        max_rows = height // _ch
-        start_time = datetime.datetime.now()
-        button_setup()
+        frame = FrameDiffer(device)
+        render_scheduler = RenderScheduler()
+        fetch_scheduler = FetchScheduler(on_update=render_scheduler.notify)
+        setup(device.size, make_font("ProggyTiny.ttf", font_size), fetch_scheduler)
+        # After the screen has seen the press
+        button.add_listener(render_scheduler.notify)
+        fetch_scheduler.start()
+        button.setup()
+        metrics.start_exporter()
         main()
     except KeyboardInterrupt:
         pass
     finally:
-        GPIO.cleanup() # Clean up
+        button.cleanup()
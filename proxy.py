@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local caching API proxy
+#
+# Several displays showing the same site can share one upstream fetch: run
+# this on one machine and point the displays at it with
+#
+#   SL_API_BASE=http://proxyhost:8090
+#   SRV_API_BASE=http://proxyhost:8090
+#
+# The upstream calls carry the proxy's API key, so it only listens on
+# localhost unless PROXY_HOST says otherwise; open it up (e.g. 0.0.0.0)
+# on a trusted network only.
+#
+# It answers the same paths as api.sl.se and srvatervinning.se, fetches
+# every site (or address) once per TTL with its own REALTIME_API_KEY and
+# serves the payload trimmed to the fields the displays use. Concurrent
+# misses for the same site wait for one upstream call, and when upstream
+# fails the last good payload is served for a while.
+#
+#   PROXY_HOST=127.0.0.1       Address to listen on
+#   PROXY_PORT=8090            Port to listen on
+#   PROXY_SL_TTL=30            Seconds SL departures are served from the cache
+#   PROXY_SRV_TTL=3600         Seconds the SRV calendar is served from the cache
+#   SL_UPSTREAM, SRV_UPSTREAM  Upstream base URLs
+#
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, quote, urlsplit
+
+from helpers import ApiException
+from helpers import print_log
+from departures import trim_items
+import http_client
+import jsonstream
+import metrics
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path='.env', encoding='utf8')
+
+sl_path = '/api2/realtimedeparturesV4.json'
+srv_path = '/rest-api/core/sewagePickup/search'
+sl_transport_types = ('Metros', 'Buses', 'Trains', 'Trams', 'Ships')
+stale_factor = 10 # Serve a cached payload up to X TTLs old while upstream fails
+upstream_wait = 30 # Seconds a request waits for an upstream call made by another request
+evict_interval = 60 # Drop entries too old to serve every X seconds
+
+PROXY_HOST = os.getenv("PROXY_HOST", "127.0.0.1")
+PROXY_PORT = int(os.getenv("PROXY_PORT", 8090))
+PROXY_SL_TTL = int(os.getenv("PROXY_SL_TTL", 30))
+PROXY_SRV_TTL = int(os.getenv("PROXY_SRV_TTL", 3600))
+SL_UPSTREAM = os.getenv("SL_UPSTREAM", "http://api.sl.se")
+SRV_UPSTREAM = os.getenv("SRV_UPSTREAM", "https://www.srvatervinning.se")
+REALTIME_API_KEY = os.getenv("REALTIME_API_KEY")
+
+proxy_requests = metrics.counter('pisl_proxy_requests_total', 'Proxy requests by route and cache result.')
+
+
+class CoalescingCache:
+    """
+    TTL cache where concurrent misses for a key share one load() call.
+    Entries older than stale_factor TTLs are dropped.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} # key -> (value, fetched_at)
+        self.ttls = {} # key -> TTL of the last request
+        self.loading = {} # key -> Future of the load in flight
+        self.failed = {} # key -> time of the last failed load
+        self.evicted_at = time.time()
+
+    def evict(self, now):
+        # Called with the lock held
+        for key, (_value, fetched_at) in list(self.entries.items()):
+            if now - fetched_at >= self.ttls[key] * stale_factor:
+                del self.entries[key]
+                del self.ttls[key]
+                self.failed.pop(key, None)
+        for key in [key for key in self.failed if key not in self.entries]:
+            del self.failed[key]
+        self.evicted_at = now
+
+    def get(self, key, ttl, load):
+        # Returns (value, cache result)
+        now = time.time()
+        with self.lock:
+            if now - self.evicted_at >= evict_interval:
+                self.evict(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.ttls[key] = ttl
+            if entry is not None and now - entry[1] < ttl:
+                return entry[0], 'hit'
+            if entry is not None and now - self.failed.get(key, 0) < ttl and now - entry[1] < ttl * stale_factor:
+                # Upstream failed recently, don't hammer it
+                return entry[0], 'stale'
+            future = self.loading.get(key)
+            leader = future is None
+            if leader:
+                future = self.loading[key] = Future()
+        if not leader:
+            return future.result(upstream_wait), 'coalesced'
+
+        try:
+            value = load()
+        except Exception as e:
+            with self.lock:
+                del self.loading[key]
+                self.failed[key] = time.time()
+            if entry is not None and now - entry[1] < ttl * stale_factor:
+                print_log('Proxy: {} failed, serving stale: {}'.format(key, e))
+                future.set_result(entry[0])
+                return entry[0], 'stale'
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.ttls[key] = ttl
+            self.failed.pop(key, None)
+            del self.loading[key]
+        future.set_result(value)
+        return value, 'miss'
+
+
+cache = CoalescingCache()
+
+
+def load_sl(site_id, timewindow):
+    url = "%s%s?key=%s&siteid=%s&timewindow=%s" % (SL_UPSTREAM, sl_path, REALTIME_API_KEY, site_id, timewindow)
+    keys = {'StatusCode': None, 'Message': None}
+    for transport_type in sl_transport_types:
+        keys[transport_type] = trim_items
+    data = http_client.get_json(url, parse=lambda resp: jsonstream.extract(resp.iter_content(jsonstream.chunk_size), keys))
+    if data.get('StatusCode') != 0:
+        raise ApiException('Status code is not 0: {} {}'.format(data.get('StatusCode'), data.get('Message') or ''))
+    return {transport_type: data.get(transport_type) or [] for transport_type in sl_transport_types}
+
+
+def trim_services(results):
+    # Only the container types and pickup dates are shown
+    return [{'containers': [
+        {'containerType': container['containerType'],
+         'calendars': [{'startDate': date['startDate']} for date in container['calendars']]}
+        for container in result['containers']]} for result in results]
+
+
+def load_srv(query, city):
+    url = "%s%s?query=%s&city=%s" % (SRV_UPSTREAM, srv_path, quote(query), quote(city))
+    return trim_services(http_client.get_json(url)['results'])
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # Keep-alive for the displays
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == sl_path and 'siteid' in params:
+                route = 'sl'
+                timewindow = params.get('timewindow', '30')
+                data, result = cache.get(('sl', params['siteid'], timewindow), PROXY_SL_TTL,
+                    lambda: load_sl(params['siteid'], timewindow))
+                body = {'StatusCode': 0, 'Message': None, 'ResponseData': data}
+            elif url.path == srv_path and 'query' in params:
+                route = 'srv'
+                city = params.get('city', '')
+                data, result = cache.get(('srv', params['query'], city), PROXY_SRV_TTL,
+                    lambda: load_srv(params['query'], city))
+                body = {'results': data}
+            else:
+                self.send_json(404, {'error': 'Unknown path'})
+                return
+        except Exception as e:
+            proxy_requests.inc(route=route, result='error')
+            print_log('Proxy: {} failed: {}'.format(self.path, e))
+            self.send_json(502, {'error': str(e)})
+            return
+        proxy_requests.inc(route=route, result=result)
+        self.send_json(200, body)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # Upstream calls and failures are logged instead
+
+
+class ProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64 # Don't refuse a burst of displays connecting at once
+
+
+if __name__ == "__main__":
+    if REALTIME_API_KEY is None:
+        exit("REALTIME_API_KEY env missing.")
+    server = ProxyServer((PROXY_HOST, PROXY_PORT), ProxyHandler)
+    metrics.start_exporter()
+    print_log('Proxy listening on {}:{}'.format(PROXY_HOST, PROXY_PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# API call budgets
+#
+# SL keys come with a call quota (e.g. 10000 calls a month). A TokenBucket
+# per key refills at the rate the quota allows and holds a burst of calls,
+# so busy hours can spend what the quiet hours saved. A RefreshPlanner takes
+# the refresh delay a screen would like, from what it shows, and stretches
+# it when the bucket runs low.
+#
+
+import threading
+from collections import namedtuple
+
+import clock
+import metrics
+
+# calls left now, calls per hour at the planned delay, hours until the
+# bucket runs dry at that pace (None when the pace is sustainable)
+Projection = namedtuple('Projection', ['remaining', 'calls_per_hour', 'hours_left'])
+
+budget_remaining = metrics.gauge('pisl_api_budget_remaining_calls', 'API calls left in the budget.')
+budget_hours_left = metrics.gauge('pisl_api_budget_hours_left', 'Hours until the budget runs out at the planned pace, -1 if sustainable.')
+planned_delay = metrics.gauge('pisl_refresh_delay_seconds', 'Planned delay between refreshes.')
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate # Calls per second
+        self.capacity = capacity # Most calls that can be saved up
+        self.tokens = capacity
+        self.updated = clock.now()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        with self.lock:
+            self._refill(clock.now())
+            return self.tokens
+
+    def take(self, amount=1):
+        with self.lock:
+            self._refill(clock.now())
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def wait_time(self, amount=1):
+        # Seconds until `amount` calls can be taken
+        with self.lock:
+            self._refill(clock.now())
+            return max(0, (amount - self.tokens) / self.rate)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key, quota, period, burst=None):
+    """
+    The bucket of an API key allowing `quota` calls per `period` seconds,
+    shared by everything using the key. Saves up to a day of calls unless
+    `burst` is given.
+    """
+    with _buckets_lock:
+        if key not in _buckets:
+            rate = float(quota) / period
+            capacity = burst if burst is not None else max(1, rate * 24*3600)
+            _buckets[key] = TokenBucket(rate, capacity)
+        return _buckets[key]
+
+
+class RefreshPlanner:
+
+    def __init__(self, name, bucket, cost=1):
+        self.name = name
+        self.bucket = bucket # None when the key has no known quota
+        self.cost = cost # Calls per refresh
+        self.delay = None
+        metrics.add_collector(self.collect_metrics)
+
+    def plan(self, delay):
+        """
+        Return the refresh delay to use when `delay` seconds is wanted. A
+        full bucket allows it, an emptier one stretches it up to the
+        sustainable delay at half full and twice that when empty.
+        """
+        if self.bucket is not None:
+            sustainable = self.cost / self.bucket.rate
+            fill = self.bucket.available() / self.bucket.capacity
+            delay = max(delay, sustainable * 2 * (1 - fill))
+        self.delay = delay
+        return delay
+
+    def projection(self):
+        if self.bucket is None or self.delay is None:
+            return None
+        remaining = self.bucket.available()
+        per_second = self.cost / self.delay
+        drain = per_second - self.bucket.rate
+        hours_left = remaining / drain / 3600 if drain > 0 else None
+        return Projection(int(remaining), per_second * 3600, hours_left)
+
+    def collect_metrics(self):
+        if self.delay is not None:
+            planned_delay.set(round(self.delay, 1), source=self.name)
+        projection = self.projection()
+        if projection is not None:
+            budget_remaining.set(projection.remaining, source=self.name)
+            hours_left = -1 if projection.hours_left is None else round(projection.hours_left, 2)
+            budget_hours_left.set(hours_left, source=self.name)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# Recording of a live unit
+#
+# With RECORD_FILE set every API response and button press is appended to
+# that file as one JSON line, stamped with the clock time it happened:
+#
+#   {"time": 1760781600.2, "type": "api", "url": "/api2/...&siteid=9294", "status": 200, "body": "..."}
+#   {"time": 1760781655.9, "type": "button", "channel": 15}
+#
+# API keys are left out of the URLs and a body equal to the previous one of
+# the same URL is stored as null, so a day of SL departures stays small. A
+# 304 Not Modified answered from the cached result is stored with a null
+# body too, one without a cached result (which fails) with its own body.
+# replay.py runs the screens against such a file.
+#
+
+import json
+import os
+import threading
+from urllib.parse import unquote, urlsplit
+
+import clock
+
+_lock = threading.Lock()
+_last_bodies = {} # url -> last recorded body
+
+
+def url_key(url):
+    # The path and query of url without the API key, same for every host
+    parts = urlsplit(url)
+    query = '&'.join(param for param in parts.query.split('&') if not param.startswith('key='))
+    return unquote(parts.path + ('?' + query if query else ''))
+
+
+def record_file():
+    return os.getenv("RECORD_FILE")
+
+
+def enabled():
+    return record_file() is not None
+
+
+def _write(entry):
+    path = record_file()
+    if path is None:
+        return
+    line = json.dumps(dict(time=clock.now(), **entry), ensure_ascii=False)
+    with _lock:
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(line + '\n')
+
+
+def api(url, status=None, body=None, error=None):
+    # A response (status and body text) or a failed call (error)
+    if not enabled():
+        return
+    url = url_key(url)
+    if status == 200 and body is not None:
+        with _lock:
+            if _last_bodies.get(url) == body:
+                body = None
+            else:
+                _last_bodies[url] = body
+    entry = {'type': 'api', 'url': url, 'status': status, 'body': body}
+    if error is not None:
+        entry['error'] = error
+    _write(entry)
+
+
+def button(channel):
+    if enabled():
+        _write({'type': 'button', 'channel': channel})
+
+
+def load(path):
+    """
+    Read a recording. Returns (api, buttons): api maps url_key() to a time
+    ordered list of (time, status, body, error) with every body filled in
+    and revalidated 304s turned into the 200 they were answered as,
+    buttons is a time ordered list of (time, channel).
+    """
+    api_calls = {}
+    buttons = []
+    bodies = {}
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['type'] == 'button':
+                buttons.append((entry['time'], entry.get('channel')))
+            elif entry['type'] == 'api':
+                url = entry['url']
+                status = entry.get('status')
+                body = entry.get('body')
+                if status == 304 and body is None and bodies.get(url) is not None:
+                    # The unit used the body it had
+                    status = 200
+                if status == 200:
+                    if body is None:
+                        body = bodies.get(url)
+                    bodies[url] = body
+                api_calls.setdefault(url, []).append((entry['time'], status, body, entry.get('error')))
+    for calls in api_calls.values():
+        calls.sort(key=lambda call: call[0])
+    buttons.sort()
+    return api_calls, buttons
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Relative time texts
+#
+# Formats the time to or since an epoch second in Swedish, e.g.
+# "2 dagar och 3 timmar" or "2d, 3t" in short form. Every text is cached
+# together with the span of clock seconds it stays the same for, so a
+# countdown is only formatted again when its last visible unit changes.
+# Screens read the clock once per frame and pass it as `now`.
+#
+
+from collections import OrderedDict
+
+import clock
+
+cache_size = 256 # Texts to keep
+
+# Seconds, short suffix, singular, plural
+units = (
+    (3600*24*30*365, 'å', 'år', 'år'),
+    (3600*24*30, 'm', 'månad', 'månader'),
+    (3600*24*7, 'v', 'vecka', 'veckor'),
+    (3600*24, 'd', 'dag', 'dagar'),
+    (3600, 't', 'timme', 'timmar'),
+    (60, 'm', 'minut', 'minuter'),
+    (1, 's', 'sekund', 'sekunder'),
+)
+
+_cache = OrderedDict() # key -> (text, valid_from, valid_until)
+
+
+def _format(diff, max_precision, short, granularity):
+    """
+    Returns (text, down, up): the text of `diff` seconds, which stays the
+    same while diff shrinks by at most `down` and grows by less than `up`.
+    """
+    out = []
+    left = diff
+    up = float('inf')
+    for unit, suffix_short, suffix, suffix_plural in units:
+        if unit < granularity:
+            break
+        if left < unit:
+            # Shows up once the remainder reaches the unit
+            up = min(up, unit - left)
+            continue
+        val = left // unit
+        if short:
+            out.append('{}{}'.format(val, suffix_short))
+        else:
+            out.append('{} {}'.format(val, suffix if val == 1 else suffix_plural))
+        # Shows val + 1 once the remainder reaches the unit
+        up = min(up, (val + 1) * unit - left)
+        left -= val * unit
+        if len(out) == max_precision:
+            break
+    if len(out) > 1 and not short:
+        text = '{} och {}'.format(', '.join(out[:-1]), out[-1])
+    else:
+        text = ', '.join(out)
+    return text, left, up
+
+
+def _lookup(ts, now, absVal, max_precision, short, granularity):
+    key = (ts, absVal, max_precision, short, granularity)
+    entry = _cache.get(key)
+    if entry is not None and entry[1] <= now < entry[2]:
+        _cache.move_to_end(key)
+        return entry
+    diff = int(ts - now)
+    if diff < 0 and not absVal:
+        # In the past, shown as nothing from now on
+        entry = ('', ts, float('inf'))
+    elif diff >= 0:
+        # Counting down, the text changes when less than it shows is left
+        text, down, up = _format(diff, max_precision, short, granularity)
+        entry = (text, now - up + 1, now + down + 1)
+    else:
+        # Counting up
+        text, down, up = _format(-diff, max_precision, short, granularity)
+        entry = (text, now - down, now + up)
+    _cache[key] = entry
+    if len(_cache) > cache_size:
+        _cache.popitem(last=False)
+    return entry
+
+
+def relative(ts, now=None, absVal=True, max_precision=6, short=False, granularity=1):
+    """
+    The time between `now` and epoch second `ts`, in the largest units
+    first and at most `max_precision` of them, leaving out units shorter
+    than `granularity` seconds. Without absVal past times give ''.
+    """
+    if now is None:
+        now = clock.now()
+    return _lookup(ts, int(now), absVal, max_precision, short, granularity)[0]
+
+
+def changes_at(ts, now=None, absVal=True, max_precision=6, short=False, granularity=1):
+    # When relative() of ts shows something else, None if never
+    if now is None:
+        now = clock.now()
+    until = _lookup(ts, int(now), absVal, max_precision, short, granularity)[2]
+    return None if until == float('inf') else until
+
+
+def relative_many(targets, now=None, absVal=True, max_precision=6, short=False, granularity=1):
+    """
+    relative() of every epoch second in targets at the same `now`. Returns
+    (texts, when the first of them changes or None).
+    """
+    if now is None:
+        now = clock.now()
+    now = int(now)
+    texts = []
+    first_change = float('inf')
+    for ts in targets:
+        text, valid_from, valid_until = _lookup(ts, now, absVal, max_precision, short, granularity)
+        texts.append(text)
+        first_change = min(first_change, valid_until)
+    return texts, None if first_change == float('inf') else first_change
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+#
+# Event driven redraws
+#
+# Screens tell when their visible content can change next (a countdown
+# crossing a minute, a blink phase, an active hours edge...) and the render
+# loop sleeps exactly until then. New data and button presses wake it up
+# early through notify().
+#
+
+import threading
+
+import clock
+
+# Never sleep longer than X seconds, in case an edge was missed. Kept below
+# fetcher.idle_timeout: every redraw uses the screen's fetchers, so they
+# keep refreshing while the screen shows nothing new for a while.
+max_sleep = 20
+
+
+class RenderScheduler:
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.wakeups = 0
+
+    def notify(self, *args):
+        # Usable as button listener and fetch update callback
+        self._event.set()
+
+    def wait_until(self, when):
+        """
+        Sleep until the epoch time `when` (None meaning no known change) or
+        until notify() is called. Returns True when woken by notify().
+        """
+        timeout = max_sleep
+        if when is not None:
+            timeout = min(max(0, when - clock.now()), max_sleep)
+        notified = clock.wait(self._event, timeout)
+        self._event.clear()
+        self.wakeups += 1
+        return notified
+
+
+def earliest(*times):
+    # The first of the given epoch times, ignoring None
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
+
+
+def next_minute_change(expected, now):
+    # When a whole-minute countdown to `expected` shows a new value
+    return now + (expected - now) % 60 + 1
+
+
+def next_step(start, step, now):
+    # The next multiple of `step` seconds after `start`
+    return start + ((now - start) // step + 1) * step
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Replay a recording at high speed
+#
+# Runs the screens of runtime.py against a recording made on a unit with
+# RECORD_FILE set (see recorder.py), on a luma dummy device and with a clock
+# running --speed times faster than real time. API calls are answered with
+# the response the unit got at that (clock) time and the button is pressed
+# when it was pressed on the unit, so a day of fetching, rendering and
+# active hours takes under two minutes at 1000x. Takes the same .env as
+# runtime.py, without needing the API keys.
+#
+#   python replay.py recording.jsonl                  Replay all of it at 1000x
+#   python replay.py recording.jsonl --speed 100 --duration 3600 --metrics replay.prom
+#   python replay.py recording.jsonl -- --display pygame --width 128 --height 64
+#
+# Arguments after -- create the devices like runtime.py does, e.g. a luma
+# emulator to watch the replay.
+#
+
+import argparse
+import bisect
+import io
+import os
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('REALTIME_API_KEY', 'replay')
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from luma.core.device import dummy
+
+import button
+import clock
+import disk_cache
+import fetcher
+import framediff
+import http_client
+import logsink
+import metrics
+import recorder
+import runtime
+from fetcher import FetchScheduler
+from helpers import make_font
+from helpers import print_log
+from oled_options import get_devices
+from render_scheduler import RenderScheduler
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport adapter answering every request with the recorded response
+    of the same URL that was current at the clock time, or the first one.
+    """
+
+    def __init__(self, api_calls):
+        requests.adapters.BaseAdapter.__init__(self)
+        self.api_calls = api_calls
+        self.times = {url: [call[0] for call in calls] for url, calls in api_calls.items()}
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        url = recorder.url_key(request.url)
+        calls = self.api_calls.get(url)
+        if not calls:
+            raise requests.ConnectionError('Not in the recording: {}'.format(url))
+        index = max(0, bisect.bisect_right(self.times[url], clock.now()) - 1)
+        _time, status, body, error = calls[index]
+        if error is not None:
+            raise requests.ConnectionError(error)
+        resp = requests.Response()
+        resp.status_code = status
+        resp.reason = 'Replayed'
+        resp.headers = CaseInsensitiveDict({'Content-Type': 'application/json; charset=utf-8'})
+        resp.raw = io.BytesIO((body or '').encode('utf-8'))
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+def press_buttons(buttons, stop):
+    # Press the button at the recorded times
+    for when, channel in buttons:
+        if clock.wait(stop, max(0, when - clock.now())):
+            return
+        button.press(channel if channel is not None else button.button_gpio_pin)
+
+
+def total(counter, **labels):
+    # Sum of a counter over the series matching labels
+    wanted = set(labels.items())
+    return sum(value for key, value in counter.values.items() if wanted <= set(key))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a pisl recording at high speed')
+    parser.add_argument('recording', help='file written with RECORD_FILE')
+    parser.add_argument('--speed', type=float, default=1000, help='times faster than real time')
+    parser.add_argument('--duration', type=float, help='seconds to replay, default all of the recording')
+    parser.add_argument('--screens', default=runtime.SCREENS, help='screen modules, like SCREENS')
+    parser.add_argument('--layout', default=runtime.SCREEN_LAYOUT, choices=('rotate', 'stack'))
+    parser.add_argument('--displays', type=int, default=1, help='dummy devices to drive')
+    parser.add_argument('--displays-layout', default=runtime.DISPLAYS_LAYOUT, choices=('mirror', 'tile'))
+    parser.add_argument('--metrics', help='write the metrics to this textfile at the end')
+    parser.add_argument('device_args', nargs='*', help='luma device arguments after --')
+    args = parser.parse_args()
+
+    api_calls, buttons = recorder.load(args.recording)
+    times = [call[0] for calls in api_calls.values() for call in calls] + [when for when, _channel in buttons]
+    if not times:
+        exit('Nothing recorded in {}.'.format(args.recording))
+    start = min(times)
+    end = start + args.duration if args.duration is not None else max(times)
+
+    # Start cold like a booting unit, without touching its cache and logs
+    disk_cache.cache_dir = tempfile.mkdtemp(prefix='pisl-replay-')
+    logsink.log_dir = os.path.join(disk_cache.cache_dir, 'logs')
+    adapter = ReplayAdapter(api_calls)
+    session = http_client.get_session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    clock.install(clock.ScaledClock(start, args.speed))
+
+    if args.device_args:
+        devices = get_devices(args.device_args)
+    else:
+        devices = [dummy(width=128, height=64) for _i in range(args.displays)]
+    frame = runtime.make_frame(devices, args.displays_layout)
+    font = make_font("ProggyTiny.ttf", runtime.font_size)
+    render_scheduler = RenderScheduler()
+    fetch_scheduler = FetchScheduler(on_update=render_scheduler.notify)
+    names = [name.strip() for name in args.screens.split(',') if name.strip()]
+    screens = runtime.load_screens(names, frame.size, font, fetch_scheduler, args.layout)
+    # The screens loaded the unit's .env, don't record the replay itself
+    os.environ.pop('RECORD_FILE', None)
+    button.add_listener(render_scheduler.notify)
+    fetch_scheduler.start()
+    stop = threading.Event()
+    threading.Thread(target=press_buttons, args=(buttons, stop), name='replay-buttons', daemon=True).start()
+
+    print_log('Replaying {:.0f}s of {} at {:g}x'.format(end - start, args.recording, args.speed))
+    real_start = time.monotonic()
+    try:
+        runtime.main(frame, screens, args.layout, render_scheduler, until=end)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    real_time = time.monotonic() - real_start
+
+    render_counts, render_total = framediff.render_time.values.get((), ([0], 0))
+    print_log('Replayed {:.0f}s in {:.1f}s'.format(clock.now() - start, real_time))
+    print_log('Frames: {} drawn, {} pushed partially, {} fully, {} unchanged, {:.2f} ms per frame drawn'.format(
+        render_counts[-1], total(framediff.frames, result='partial'), total(framediff.frames, result='full'),
+        total(framediff.frames, result='skipped'), 1000.0 * render_total / max(1, render_counts[-1])))
+    print_log('Wakeups: {}, API calls: {}, fetches: {} ok, {} failed, button presses: {}'.format(
+        render_scheduler.wakeups, adapter.calls, total(fetcher.fetches, result='ok'),
+        total(fetcher.fetches, result='error'), total(button.presses)))
+    if args.metrics:
+        metrics.write_textfile(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Retry policy for failing API calls
+#
+# Exponential backoff with full jitter (a random delay between 0 and the
+# exponential ceiling) so displays that fail together don't retry together,
+# plus a circuit breaker that stops calling the API altogether after N
+# consecutive failures. Errors that won't go away by waiting (bugs, bad
+# keys) are only retried after the longest delay.
+#
+
+import random
+
+import clock
+
+
+class CircuitBreaker:
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=600):
+        self.failure_threshold = failure_threshold # Open after X consecutive failures
+        self.reset_timeout = reset_timeout # Seconds to stay open before a trial call
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if clock.now() - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        # A half open breaker lets calls through until one of them fails
+        return self.state != self.OPEN
+
+    def open_until(self):
+        if self.opened_at is None:
+            return None
+        return self.opened_at + self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = clock.now()
+
+
+class RetryPolicy:
+
+    def __init__(self, base_delay, max_delay, min_delay=1, retry_on=(Exception,), breaker=None):
+        self.base_delay = base_delay # Backoff ceiling after the first failure
+        self.max_delay = max_delay # Backoff ceiling never grows beyond this
+        self.min_delay = min_delay
+        self.retry_on = retry_on # Exception types that are expected to go away
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.attempt = 0
+
+    def should_retry(self, e):
+        # False for errors only worth trying again now and then
+        return isinstance(e, self.retry_on)
+
+    def allow(self):
+        return self.breaker.allow()
+
+    def success(self):
+        self.attempt = 0
+        self.breaker.record_success()
+
+    def failure(self, e=None):
+        """
+        Register a failed call and return the number of seconds to wait
+        before the next one.
+        """
+        self.attempt += 1
+        self.breaker.record_failure()
+
+        ceiling = min(self.max_delay, self.base_delay * 2 ** min(self.attempt - 1, 32))
+        delay = max(self.min_delay, random.uniform(0, ceiling))
+        if e is not None and not self.should_retry(e):
+            delay = self.max_delay
+
+        # The server knows best when it will be back
+        retry_after = getattr(e, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+
+        open_until = self.breaker.open_until()
+        if open_until is not None:
+            delay = max(delay, open_until - clock.now())
+        return delay
+
+    def wait_time(self):
+        # Seconds until the breaker lets the next call through
+        open_until = self.breaker.open_until()
+        if open_until is None or self.breaker.state != CircuitBreaker.OPEN:
+            return 0
+        return max(0, open_until - clock.now())
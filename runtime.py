@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Run several screens in one process
+#
+# The screen modules (pisl, srv, atd) are loaded as plugins sharing one
+# canvas, one font, one button and one fetch scheduler. Screens are either
+# rotated or stacked on top of each other:
+#
+#   SCREENS=pisl,srv,atd     Screen modules to load, in order
+#   SCREEN_LAYOUT=rotate     rotate: one screen at a time, stack: split the rows
+#   SCREEN_ROTATE_DELAY=10   Seconds each screen is shown when rotating
+#   DISPLAYS_LAYOUT=mirror   With several displays, mirror: all show the same,
+#                            tile: the frame spans the displays top to bottom
+#
+# Several displays are given as luma arguments separated by '+', e.g.
+#
+#   runtime.py --display ssd1306 --i2c-port 1 + --display ssd1306 --i2c-port 3
+#
+
+import importlib
+import os
+
+from helpers import make_font
+from helpers import char_size
+from fetcher import FetchScheduler
+from render_scheduler import RenderScheduler
+from render_scheduler import earliest
+from render_scheduler import next_step
+import button
+import clock
+import metrics
+
+from oled_options import get_devices
+from framediff import FrameDiffer
+from framediff import MultiFrame
+from PIL import Image, ImageDraw
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path='.env', encoding='utf8')
+
+font_size = 15
+
+SCREENS = os.getenv("SCREENS", "pisl,srv,atd")
+SCREEN_LAYOUT = os.getenv("SCREEN_LAYOUT", "rotate")
+SCREEN_ROTATE_DELAY = int(os.getenv("SCREEN_ROTATE_DELAY", 10))
+DISPLAYS_LAYOUT = os.getenv("DISPLAYS_LAYOUT", "mirror")
+
+
+class Screen:
+
+    def __init__(self, module, offset, size):
+        self.module = module
+        self.name = module.__name__
+        self.offset = offset # y offset when stacked
+        self.size = size
+
+    def draw(self, draw):
+        return self.module.draw_screen(draw)
+
+    def draw_stacked(self, draw):
+        # Draw into a private bitmap and blit it into the frame at our offset
+        image = Image.new('1', self.size)
+        drawn = self.module.draw_screen(ImageDraw.Draw(image))
+        if drawn:
+            draw.bitmap((0, self.offset), image, fill="white")
+        return drawn
+
+    def next_redraw(self):
+        return self.module.next_redraw()
+
+
+def load_screens(names, size, font, fetch_scheduler, layout):
+    width, height = size
+    _cw, line_height = char_size(font)
+    rows = height // line_height
+    if layout == 'stack' and len(names) > rows:
+        exit("Can't stack {} screens in {} rows.".format(len(names), rows))
+
+    screens = []
+    offset = 0
+    for i, name in enumerate(names):
+        module = importlib.import_module(name)
+        if layout == 'stack':
+            # Split the rows evenly, the last screen gets what is left
+            screen_rows = rows // len(names) if i < len(names) - 1 else rows - offset // line_height
+            screen_size = (width, screen_rows * line_height)
+        else:
+            screen_size = size
+        module.setup(screen_size, font, fetch_scheduler)
+        screens.append(Screen(module, offset, screen_size))
+        if layout == 'stack':
+            offset += screen_size[1]
+    return screens
+
+
+def make_frame(devices, layout):
+    # Where frames are drawn and pushed, one canvas for all devices
+    if len(devices) == 1:
+        return FrameDiffer(devices[0])
+    if len(set(device.size for device in devices)) > 1:
+        exit("Displays must have the same size.")
+    return MultiFrame(devices, tile=layout == 'tile')
+
+
+def draw_rotate(draw, screens):
+    # Show the current screen, or the next one having something to show.
+    # Returns when the frame changes next.
+    now = clock.now()
+    current = int(now // SCREEN_ROTATE_DELAY) % len(screens)
+    rotate_at = next_step(0, SCREEN_ROTATE_DELAY, now)
+    for i in range(len(screens)):
+        screen = screens[(current + i) % len(screens)]
+        if screen.draw(draw):
+            return earliest(screen.next_redraw(), rotate_at)
+    # Nothing to show, wait for a screen to turn on by itself
+    return earliest(*[screen.next_redraw() for screen in screens])
+
+
+def draw_stack(draw, screens):
+    for screen in screens:
+        screen.draw_stacked(draw)
+    return earliest(*[screen.next_redraw() for screen in screens])
+
+
+def main(frame, screens, layout, render_scheduler, until=None):
+    # Runs forever, or until epoch time `until` (replays)
+    draw_frame = draw_stack if layout == 'stack' else draw_rotate
+
+    while until is None or clock.now() < until:
+        with frame.canvas() as draw:
+            redraw_at = draw_frame(draw, screens)
+        # Sleep until something visible changes, new data or a button press
+        render_scheduler.wait_until(redraw_at)
+
+
+if __name__ == "__main__":
+    names = [name.strip() for name in SCREENS.split(',') if name.strip()]
+    if not names:
+        exit("SCREENS env empty.")
+    if SCREEN_LAYOUT not in ('rotate', 'stack'):
+        exit("SCREEN_LAYOUT must be rotate or stack.")
+    if DISPLAYS_LAYOUT not in ('mirror', 'tile'):
+        exit("DISPLAYS_LAYOUT must be mirror or tile.")
+
+    try:
+        frame = make_frame(get_devices(), DISPLAYS_LAYOUT)
+        font = make_font("ProggyTiny.ttf", font_size)
+        render_scheduler = RenderScheduler()
+        fetch_scheduler = FetchScheduler(on_update=render_scheduler.notify)
+        screens = load_screens(names, frame.size, font, fetch_scheduler, SCREEN_LAYOUT)
+        # After the screens have seen the press
+        button.add_listener(render_scheduler.notify)
+        fetch_scheduler.start()
+        button.setup()
+        metrics.start_exporter()
+        main(frame, screens, SCREEN_LAYOUT, render_scheduler)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        button.cleanup()
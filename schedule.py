@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# Active hours schedule
+#
+# ACTIVE_HOURS is a cron expression, the screen is active when the next cron
+# match is less than `limit` seconds away. The expression is compiled once
+# and the current on/off window is precomputed, so asking whether the screen
+# is active (and when that changes) is a comparison until the window ends.
+#
+
+import datetime
+import time
+
+import clock
+
+horizon = 3600*24 # Don't merge cron matches into one window further ahead than X seconds
+
+
+class ActiveHours:
+
+    def __init__(self, expression, limit):
+        import croniter
+        self._croniter = croniter.croniter
+        self.expression = expression
+        self.limit = limit
+        self._croniter(expression) # Fail early on a broken expression
+        self.window_start = None # Active after this (epoch seconds)...
+        self.window_end = None # ...until this
+        self.computed_at = None
+
+    def _next_match(self, cron):
+        return time.mktime(cron.get_next(datetime.datetime).timetuple())
+
+    def _compute(self, now):
+        cron = self._croniter(self.expression, datetime.datetime.fromtimestamp(now))
+        first = self._next_match(cron)
+        end = first
+        # Matches closer than `limit` to each other make one long window
+        while end - first < horizon:
+            match = self._next_match(cron)
+            if match - end >= self.limit:
+                break
+            end = match
+        self.window_start = first - self.limit
+        self.window_end = end
+        self.computed_at = now
+
+    def _update(self, now):
+        if self.window_end is None or now >= self.window_end or now < self.computed_at:
+            self._compute(now)
+
+    def is_active(self, now=None):
+        if now is None:
+            now = clock.now()
+        self._update(now)
+        return now > self.window_start
+
+    def next_change(self, now=None):
+        # Epoch seconds when is_active() flips next
+        if now is None:
+            now = clock.now()
+        self._update(now)
+        return self.window_end if now > self.window_start else self.window_start
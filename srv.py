@@ -2,42 +2,48 @@
 # -*- coding: utf-8 -*-
 #
 
-import requests
-import datetime
-import time
 import os
-import math
 import re
-import sys, traceback
 
 from helpers import make_font
+from helpers import char_size
+from glyphs import GlyphAtlas
 from helpers import time_diff
-from helpers import tdiff
-from helpers import tdiff_text
-from helpers import is_active_hours
 from helpers import print_log
 from helpers import ApiException
-from requests import ReadTimeout, ConnectTimeout, HTTPError, Timeout, ConnectionError
-from urllib3.exceptions import NewConnectionError
+from schedule import ActiveHours
+from fetcher import Fetcher
+from fetcher import FetchScheduler
+from render_scheduler import RenderScheduler
+from render_scheduler import earliest
+from retry import RetryPolicy
+from retry import CircuitBreaker
+from pickups import PickupCalendar
+from pickups import rows as pickup_rows
+import http_client
 
 from oled_options import get_device
-from luma.core.render import canvas
-from PIL import ImageFont
-from dateutil.parser import parse
-import RPi.GPIO as GPIO # Import Raspberry Pi GPIO library
+from framediff import FrameDiffer
+import button
+import clock
+import metrics
 
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path='.env', encoding='utf8')
 
-data_refresh_delay_normal = 3600*12 # Normal API frefresh fequency
+data_refresh_delay_normal = 3600*24 # Normal API frefresh fequency, the calendar rarely changes
 data_refresh_delay_fast = 3600*4 # A faster API refresh freqency
+data_retry_delay = 60 # First retry of a failed API call within X seconds, doubling for every failure
+data_retry_delay_max = 3600*2 # Never wait longer than X seconds between retries
+api_failure_threshold = 5 # Stop calling the API after X consecutive failures...
+api_circuit_reset_time = 3600 # ...for X seconds
 
-screen_data_refresh_delay = 1 # Redraw (cached) data every X seconds
-screen_data_refresh_delay_flash = 1
+screen_flash_period = 3 # Blink period in seconds...
+screen_flash_off_time = 1 # ...of which the screen is blank for X seconds
 screen_active_time = 120 # In seconds, how long the screen is active after button press (during off-hours)
 
-start_time = datetime.datetime.now()
+start_time = clock.datetime_now()
 
 row = 0
 max_rows = 0
@@ -45,34 +51,32 @@ font_size = 15
 width = 0
 height = 0
 line_height = 0
-button_gpio_pin = 15
+atlas = None
 
-last_get_services = None
 button_press_time = None
-srv_services = None
+active_hours = None
+srv_fetcher = None
+next_redraw_at = None
 screen_flash = True
 screen_flash_test = False
-debug_count = 0
 
 SRV_STREETNAME = os.getenv("SRV_STREETNAME")
 SRV_CITY = os.getenv("SRV_CITY")
+SRV_API_BASE = os.getenv("SRV_API_BASE", "https://www.srvatervinning.se") # e.g. a local proxy.py
 
 ACTIVE_HOURS = os.getenv("ACTIVE_HOURS")
 
+SRV_CACHE_MAX_AGE = int(os.getenv("SRV_CACHE_MAX_AGE", 3600*24*7)) # Don't start from a cached calendar older than X seconds
+
 def button_callback(channel):
     global button_press_time
     # Set button press time
-    button_press_time = datetime.datetime.now()
+    button_press_time = clock.datetime_now()
     # Force API refresh
-    last_get_services = None
+    if srv_fetcher is not None:
+        srv_fetcher.refresh()
     print("Button was pushed!")
 
-def button_setup():
-    GPIO.setwarnings(False) # Ignore warning for now
-    GPIO.setmode(GPIO.BOARD) # Use physical pin numbering
-    GPIO.setup(button_gpio_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN) # Set pin to be an input pin and set initial value to be pulled low (off)
-    GPIO.add_event_detect(button_gpio_pin,GPIO.RISING,callback=button_callback) # Setup event on pin rising edge
-
 def print_out(left_text='', right_text='', draw=None):
     global row
     if draw is None:
@@ -87,136 +91,135 @@ def print_out(left_text='', right_text='', draw=None):
 
         y = row * line_height
         row += 1
-        draw.text((0, y), left_text + ' ' + right_text, font=font, fill="white")
-
-def get_srv_date(iso_date):
-    p = re.compile(r'(?P<year>.+)-(?P<month>\d+)-(?P<day>.+)')
-    m = p.search(iso_date);
-    day = int(m.group('day'))
-    month = int(m.group('month'))
-    year = int(m.group('year'))
-   
-    return datetime.datetime(year, month, day, 9, 0, 0)
+        atlas.text(draw, (0, y), left_text + ' ' + right_text)
 
-def get_services():
+def fetch_services():
     print_log('Making API call...')
     
-    url = "https://www.srvatervinning.se/rest-api/core/sewagePickup/search?query=%s&city=%s" % (SRV_STREETNAME, SRV_CITY)
-    resp = requests.get(url)
+    url = "%s/rest-api/core/sewagePickup/search?query=%s&city=%s" % (SRV_API_BASE, SRV_STREETNAME, SRV_CITY)
+    json = http_client.get_json(url)
+    return json['results']
 
-    if resp.status_code != 200:
-        raise ApiException('HTTP return code is not 200: {}'.format(resp.status_code))
-    json = resp.json()
-    
-    services = {}
-    now = time.mktime(time.localtime())
-    
-    for result in json['results']:
-
-        for container in result['containers']:
-            for date in container['calendars']:
-                dt = get_srv_date(date['startDate'])
-                ts = time.mktime(dt.timetuple())
-                if ts >= now:
-                    dfmt = '%-d/%-m'
-                    dfmt = dt.strftime(dfmt.replace('%-', '%#') if os.name == 'nt' else dfmt)
-                    next_text = u'{} {}{} {}'.format(container['containerType'].replace(u'Kärl 370 liter kärl', 'K').replace(u' restavfall', '').replace(u' färgsortering', ''), dfmt, ' ' * (5 - len(dfmt)), tdiff_text(ts, True, 2, True).replace(' ', ''))
-                    services[ts] = next_text
-    return services
+def parse_services(results):
+    calendar = PickupCalendar.from_json(results)
+    if not calendar.upcoming(clock.now()):
+        raise ApiException('Empty result')
+    return calendar
+
+def get_services():
+    return parse_services(fetch_services())
 
 def draw_srv(draw, data_refresh_delay):
+    # Returns when the drawn content changes next, None if only new data changes it
     global row
-    global last_get_services
-    global srv_services
     global screen_flash
-    global debug_count
-    if srv_services is None or time_diff(last_get_services) > data_refresh_delay:
-        try:
-            srv_services = get_services()
-        except ApiException as e:
-            print_out(str(e), '', draw=draw)
-            print_log('E1')
-            print_log(str(e))
-            time.sleep(30)
-            return
-        except (ConnectionError, ConnectTimeout, HTTPError, ReadTimeout, Timeout, NewConnectionError) as e:
-            print_out(str(e), '', draw=draw)
-            print_log('E2')
-            print_log(str(e))
-            print_log('-'*60)
-            print_log(traceback.format_exc())
-            print_log('-'*60)
-            time.sleep(300) # 5m
-            print_log('-DEBUG-')
-            time.sleep(100)
-            print_log('-DEBUG_2-')
-            debug_count = debug_count + 1  
-            print_log(debug_count)
-            return
-        except ValueError as e: # Can be internet connection failure
-            print_out(str(e), '', draw=draw)
-            print_log('E3')
-            print_log(str(e))
-            time.sleep(60 * 5) # 5m
-            return
-        last_get_services = datetime.datetime.now()
-        if len(srv_services) == 0:
-            print_log('Empty result')
-            time.sleep(60 * 5) # 5m
-            return
-
-    for key in sorted(srv_services):
-        if screen_flash and (tdiff(int(key), False) < 3600*24 or screen_flash_test):
-            time.sleep(screen_data_refresh_delay_flash)
-            screen_flash = False
-            return
-        break
-
-    for key in sorted(srv_services):
-        if(row < max_rows):
-            print_out(srv_services[key], draw=draw)
-
-    screen_flash = True
+    snapshot = srv_fetcher.use(data_refresh_delay)
+    if snapshot is None:
+        if srv_fetcher.error is not None:
+            print_out(str(srv_fetcher.error), draw=draw)
+        row = 0
+        return None
+    now = clock.now()
+    pickups = snapshot.data.upcoming(now)
+    changes_at = None
+
+    if pickups:
+        # Blink when the next pickup is less than a day away
+        if pickups[0].ts - int(now) < 3600*24 or screen_flash_test:
+            # Blank for the last screen_flash_off_time seconds of every period
+            second = int(now)
+            phase = second % screen_flash_period
+            on_time = screen_flash_period - screen_flash_off_time
+            screen_flash = phase < on_time
+            changes_at = second - phase + (on_time if screen_flash else screen_flash_period)
+            if not screen_flash:
+                return changes_at
+        else:
+            changes_at = pickups[0].ts - 3600*24
+
+    texts, rows_change_at = pickup_rows(pickups[:max_rows - row], now)
+    for text in texts:
+        print_out(text, draw=draw)
+    # The relative times count down
+    changes_at = earliest(changes_at, rows_change_at)
+
     # Reset row
     row = 0
+    return changes_at
+
+
+def draw_screen(draw):
+    global next_redraw_at
+    # Only draw if started recently
+    if time_diff(start_time) < screen_active_time:
+        changes_at = draw_srv(draw, data_refresh_delay_normal)
+        active_until = start_time.timestamp() + screen_active_time
+    # Or only draw if active hours
+    elif active_hours is not None and active_hours.is_active():
+        changes_at = draw_srv(draw, data_refresh_delay_normal)
+        active_until = active_hours.next_change()
+    # Or if button is pressed recently
+    elif button_press_time is not None and time_diff(button_press_time) < screen_active_time:
+        changes_at = draw_srv(draw, data_refresh_delay_fast)
+        active_until = button_press_time.timestamp() + screen_active_time
+    else:
+        next_redraw_at = next_change()
+        return False
+    next_redraw_at = earliest(changes_at, active_until)
+    return True
+
+def next_redraw():
+    # When the screen content can change next, None if only events change it
+    return next_redraw_at
+
+def next_change():
+    # When the screen turns on by itself, None if only the button can do it
+    if active_hours is None:
+        return None
+    return active_hours.next_change()
+
+def setup(size, screen_font, fetch_scheduler):
+    global width, height, font, max_chars, line_height, max_rows, start_time, active_hours, srv_fetcher, atlas
+    if SRV_STREETNAME is None:
+        exit("SRV_STREETNAME env missing.")
+    width, height = size
+    font = screen_font
+    atlas = GlyphAtlas(font)
+    char_width, line_height = char_size(font)
+    max_chars = width // char_width
+    max_rows = height // line_height
+    start_time = clock.datetime_now()
+    if ACTIVE_HOURS is not None:
+        active_hours = ActiveHours(ACTIVE_HOURS, screen_active_time)
+    retry = RetryPolicy(data_retry_delay, data_retry_delay_max, retry_on=http_client.RETRYABLE_ERRORS,
+        breaker=CircuitBreaker(api_failure_threshold, api_circuit_reset_time))
+    srv_fetcher = fetch_scheduler.add(Fetcher('SRV', fetch_services, data_refresh_delay_normal, retry,
+        parse=parse_services, cache_name='srv_{}'.format(re.sub(r'\W+', '-', '{}_{}'.format(SRV_STREETNAME, SRV_CITY or ''))),
+        max_age=SRV_CACHE_MAX_AGE))
+    button.add_listener(button_callback)
 
 def main():
 
     while True:
-        with canvas(device) as draw:
-            # Only draw if started recently
-            if time_diff(start_time) < screen_active_time:
-                draw_srv(draw, data_refresh_delay_normal)
-            # Or only draw if active hours
-            elif ACTIVE_HOURS is not None and is_active_hours(ACTIVE_HOURS, screen_active_time):
-                draw_srv(draw, data_refresh_delay_normal)
-            # Or if button is pressed recently
-            elif button_press_time is not None and time_diff(button_press_time) < screen_active_time:
-                draw_srv(draw, data_refresh_delay_fast)
-        time.sleep(screen_data_refresh_delay)
+        with frame.canvas() as draw:
+            draw_screen(draw)
+        # Sleep until something visible changes, new data or a button press
+        render_scheduler.wait_until(next_redraw_at)
 
 if __name__ == "__main__":
-    if SRV_STREETNAME is None:
-        exit("SRV_STREETNAME env missing.")
-
     try:
         device = get_device()
-        width = device.width
-        height = device.height
-        font = make_font("ProggyTiny.ttf", font_size)
-        # Find char width & height
-        _cw, _ch = (0, 0)
-        for i in range(32, 128):
-            w, h = font.getsize(chr(i))
-            _cw = max(w, _cw)
-            _ch = max(h, _ch)
-        max_chars = width // _cw
-        line_height = _ch
-        max_rows = height // _ch
-        start_time = datetime.datetime.now()
-        button_setup()
+        frame = FrameDiffer(device)
+        render_scheduler = RenderScheduler()
+        fetch_scheduler = FetchScheduler(on_update=render_scheduler.notify)
+        setup(device.size, make_font("ProggyTiny.ttf", font_size), fetch_scheduler)
+        # After the screen has seen the press
+        button.add_listener(render_scheduler.notify)
+        fetch_scheduler.start()
+        button.setup()
+        metrics.start_exporter()
         main()
     except KeyboardInterrupt:
         pass
     finally:
-        GPIO.cleanup() # Clean up
+        button.cleanup()